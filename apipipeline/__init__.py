@@ -14,6 +14,4 @@ if "SENTRY_DSN" in os.environ:
 if "DEBUG" in os.environ:
     logging.basicConfig(level=logging.DEBUG)
 else:
-    logging.basicConfig(level=logging.INFO)
-
-logging.getLogger("asyncio").setLevel(logging.DEBUG)
\ No newline at end of file
+    logging.basicConfig(level=logging.INFO)
\ No newline at end of file
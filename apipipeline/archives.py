@@ -0,0 +1,278 @@
+"""
+Read API over archived posts and blogs.
+
+    gunicorn -k gevent -b 0.0.0.0:5000 --chdir apipipeline archives:app
+
+    GET /blogs/<name>                   Blog info.
+    GET /blogs/<name>/posts?before=     Posts of a blog, newest first.
+    GET /posts?since=&until=&before=    Posts in a time range (unix timestamps), newest first.
+    GET /posts/<tumblr_id>              A post by its Tumblr id.
+
+Lists return {"posts": [...], "next": <cursor>}. Pass next back as before for
+the following page, it is null on the last one. Post JSON is streamed as
+stored, rows are never loaded into models.
+"""
+import os
+import time
+import json
+import hashlib
+import datetime
+
+from flask import Flask, Response, request, abort
+from sqlalchemy import text
+from redis.exceptions import RedisError
+
+from apipipeline.connections import create_redis
+from apipipeline.keys import ARCHIVE_CACHE
+from apipipeline.model import get_engine
+
+DEFAULT_LIMIT = int(os.environ.get("ARCHIVE_DEFAULT_LIMIT", 50))
+MAX_LIMIT = int(os.environ.get("ARCHIVE_MAX_LIMIT", 200))
+
+# Blog pages are cached in Redis, the least recently used are evicted past CACHE_ENTRIES.
+CACHE_ENTRIES = int(os.environ.get("ARCHIVE_CACHE_ENTRIES", 10000))
+CACHE_TTL = int(os.environ.get("ARCHIVE_CACHE_TTL", 300))
+CACHE_MAX_BYTES = int(os.environ.get("ARCHIVE_CACHE_MAX_BYTES", 1024 * 1024))
+
+BLOG_QUERY = text(
+    "SELECT id, updated, data::text FROM blogs WHERE name = :name ORDER BY updated DESC LIMIT 1"
+)
+
+BLOG_POSTS_QUERY = text(
+    "SELECT tumblr_id, data::text FROM posts WHERE author_id = :author_id AND tumblr_id < :before "
+    "ORDER BY tumblr_id DESC LIMIT :limit"
+)
+
+RANGE_QUERY = text(
+    "SELECT id, posted, data::text FROM posts WHERE posted >= :since AND posted < :until "
+    "AND (posted, id) < (:before_posted, :before_id) ORDER BY posted DESC, id DESC LIMIT :limit"
+)
+
+POST_QUERY = text("SELECT data::text FROM posts WHERE tumblr_id = :tumblr_id")
+
+# Larger than any Tumblr post id, the first page of a blog.
+NEWEST_ID = 2 ** 63 - 1
+
+# Timestamps past this are clamped or refused, datetime can't hold them all.
+MAX_TIMESTAMP = 2 ** 32
+
+app = Flask(__name__)
+cache_redis = None
+
+def patch_psycopg():
+    # gevent workers patch sockets, but psycopg2 waits in C unless it gets a gevent wait callback.
+    try:
+        import gevent.monkey
+        from psycogreen.gevent import patch_psycopg
+    except ImportError:
+        return
+
+    if gevent.monkey.is_module_patched("socket"):
+        # On PyPy get_engine registers psycopg2cffi as psycopg2 first.
+        get_engine()
+        patch_psycopg()
+
+patch_psycopg()
+
+def get_cache():
+    global cache_redis
+
+    if cache_redis is None:
+        cache_redis = create_redis(binary=True)
+
+    return cache_redis
+
+def int_arg(name, default=None, minimum=None, maximum=None):
+    value = request.args.get(name)
+    if value in (None, ""):
+        return default
+
+    try:
+        value = int(value)
+    except ValueError:
+        abort(400, f"{name} must be an integer.")
+
+    if minimum is not None and value < minimum:
+        abort(400, f"{name} must be at least {minimum}.")
+    if maximum is not None:
+        value = min(value, maximum)
+
+    return value
+
+def make_etag(*parts):
+    return hashlib.sha1(":".join(str(part) for part in parts).encode("utf8")).hexdigest()
+
+def not_modified(etag):
+    return etag in request.if_none_match
+
+def json_response(body, etag=None):
+    response = Response(body, mimetype="application/json")
+    if etag:
+        response.set_etag(etag)
+
+    return response
+
+def cache_get(key):
+    try:
+        pipe = get_cache().pipeline(transaction=False)
+        pipe.get(key)
+        pipe.zadd(ARCHIVE_CACHE, {key: time.time()}, xx=True)
+        return pipe.execute()[0]
+    except RedisError:
+        return None
+
+def cache_set(key, body):
+    if len(body) > CACHE_MAX_BYTES:
+        return
+
+    try:
+        redis = get_cache()
+        pipe = redis.pipeline(transaction=False)
+        pipe.set(key, body, ex=CACHE_TTL)
+        pipe.zadd(ARCHIVE_CACHE, {key: time.time()})
+        pipe.zcard(ARCHIVE_CACHE)
+        entries = pipe.execute()[-1]
+
+        # Evict the least recently used entries, expired ones are just dropped from the index.
+        if entries > CACHE_ENTRIES:
+            evicted = [member for member, _ in redis.zpopmin(ARCHIVE_CACHE, entries - CACHE_ENTRIES)]
+            if evicted:
+                redis.delete(*evicted)
+    except RedisError:
+        pass
+
+def stream_posts(query, params, cursor, on_complete=None):
+    """
+    Stream {"posts": [...], "next": ...} straight from the rows, the last
+    column of each row being the post JSON. cursor(row) is the next page's
+    before value for the last row of a full page.
+    """
+    def generate():
+        chunks = []
+        last_row = None
+        count = 0
+
+        with get_engine().connect() as conn:
+            result = conn.execution_options(stream_results=True).execute(query, **params)
+
+            chunk = b'{"posts":['
+            for row in result:
+                chunk += (b"," if count else b"") + row[-1].encode("utf8")
+                last_row = row
+                count += 1
+
+                if len(chunk) > 64 * 1024:
+                    chunks.append(chunk)
+                    yield chunk
+                    chunk = b""
+
+        next_cursor = cursor(last_row) if count == params["limit"] else None
+        chunk += b'],"next":' + json.dumps(next_cursor).encode("utf8") + b"}"
+        chunks.append(chunk)
+        yield chunk
+
+        if on_complete:
+            on_complete(b"".join(chunks))
+
+    return generate()
+
+def find_blog(name):
+    with get_engine().connect() as conn:
+        blog = conn.execute(BLOG_QUERY, name=name).fetchone()
+
+    if not blog:
+        abort(404, "No such blog.")
+
+    return blog
+
+@app.route("/blogs/<name>")
+def blog_info(name):
+    blog_id, updated, data = find_blog(name)
+    body = b'{"blog":' + data.encode("utf8") + b"}"
+    etag = make_etag(hashlib.sha1(body).hexdigest())
+
+    if not_modified(etag):
+        return Response(status=304)
+
+    return json_response(body, etag)
+
+@app.route("/blogs/<name>/posts")
+def blog_posts(name):
+    before = int_arg("before", NEWEST_ID, minimum=1, maximum=NEWEST_ID)
+    limit = int_arg("limit", DEFAULT_LIMIT, minimum=1, maximum=MAX_LIMIT)
+
+    # The blog's update time versions every page of it. Crawls keep adding older
+    # posts under the same version, so versions also expire after CACHE_TTL.
+    blog_id, updated, _ = find_blog(name)
+    etag = make_etag(blog_id, updated, before, limit, int(time.time() // CACHE_TTL))
+    if not_modified(etag):
+        return Response(status=304)
+
+    cache_key = ARCHIVE_CACHE + ":" + etag
+    body = cache_get(cache_key)
+    if body is not None:
+        return json_response(body, etag)
+
+    params = dict(author_id=blog_id, before=before, limit=limit)
+    stream = stream_posts(BLOG_POSTS_QUERY, params, lambda row: row[0], lambda body: cache_set(cache_key, body))
+
+    return json_response(stream, etag)
+
+@app.route("/posts")
+def posts_by_time():
+    now = int(time.time())
+    since = int_arg("since", 0, minimum=0, maximum=MAX_TIMESTAMP)
+    until = int_arg("until", now + 1, minimum=0, maximum=MAX_TIMESTAMP)
+    limit = int_arg("limit", DEFAULT_LIMIT, minimum=1, maximum=MAX_LIMIT)
+
+    # Cursors are "<posted timestamp>:<id>" of the last post on the page.
+    before = request.args.get("before")
+    if before:
+        try:
+            before_posted, before_id = before.split(":", 1)
+            before_posted, before_id = float(before_posted), int(before_id)
+        except ValueError:
+            abort(400, "before must be a cursor from a previous page.")
+
+        # float() takes nan and inf.
+        if not (0 <= before_posted <= MAX_TIMESTAMP and 0 < before_id <= NEWEST_ID):
+            abort(400, "before must be a cursor from a previous page.")
+    else:
+        before_posted, before_id = until, NEWEST_ID
+
+    # posted is stored naive in local time, the way the parser converts timestamps.
+    try:
+        params = dict(
+            since=datetime.datetime.fromtimestamp(since),
+            until=datetime.datetime.fromtimestamp(until),
+            before_posted=datetime.datetime.fromtimestamp(before_posted),
+            before_id=before_id,
+            limit=limit,
+        )
+    except (ValueError, OverflowError, OSError):
+        abort(400, "Timestamps out of range.")
+
+    def cursor(row):
+        return "%s:%s" % (row[1].timestamp(), row[0])
+
+    return json_response(stream_posts(RANGE_QUERY, params, cursor))
+
+@app.route("/posts/<int:tumblr_id>")
+def post_by_id(tumblr_id):
+    with get_engine().connect() as conn:
+        rows = conn.execute(POST_QUERY, tumblr_id=tumblr_id).fetchall()
+
+    if not rows:
+        abort(404, "No such post.")
+
+    # Reblogs keep their id, there can be one row per blog that has it.
+    body = b'{"posts":[' + b",".join(row[0].encode("utf8") for row in rows) + b']}'
+    etag = make_etag(hashlib.sha1(body).hexdigest())
+
+    if not_modified(etag):
+        return Response(status=304)
+
+    return json_response(body, etag)
+
+if __name__ == "__main__":
+    app.run(host="0.0.0.0", port=5000, debug="DEBUG" in os.environ)
@@ -0,0 +1,142 @@
+import os
+import gzip
+import atexit
+import json
+import time
+import random
+import struct
+import threading
+
+from apipipeline.instrumentation import WORKER_NAME
+
+# Share of queue payloads and API responses written to the capture, 0 turns it off.
+CAPTURE_RATE = float(os.environ.get("CAPTURE_RATE", 0))
+CAPTURE_DIR = os.environ.get("CAPTURE_DIR", "capture")
+CAPTURE_FILE_BYTES = int(os.environ.get("CAPTURE_FILE_BYTES", 64 * 1024 * 1024))
+CAPTURE_MAX_BYTES = int(os.environ.get("CAPTURE_MAX_BYTES", 2 * 1024 * 1024 * 1024))
+
+# Capture time, kind length, payload length.
+HEADER = struct.Struct(">dHI")
+
+class Capture(object):
+    """
+    Samples traffic into gzip files for benchmarks/replay.py. Records are a
+    kind (a queue key or "api:posts") and the payload as it was seen, with
+    the time it was seen. Every file starts with a "meta" record holding
+    the sample rate.
+
+    Files are written as .part and renamed once rotated, the oldest ones
+    are deleted past max_bytes.
+    """
+
+    def __init__(self, directory=CAPTURE_DIR, rate=CAPTURE_RATE, file_bytes=CAPTURE_FILE_BYTES, max_bytes=CAPTURE_MAX_BYTES):
+        self.directory = directory
+        self.rate = rate
+        self.file_bytes = file_bytes
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.active = None
+        self.active_path = None
+        self.sequence = 0
+
+    @property
+    def enabled(self):
+        return self.rate > 0
+
+    def sample(self, items):
+        if not self.enabled:
+            return []
+
+        return [item for item in items if random.random() < self.rate]
+
+    def file_path(self):
+        self.sequence += 1
+        filename = "capture-%s-%d-%d-%d.gz" % (WORKER_NAME, os.getpid(), int(time.time()), self.sequence)
+        return os.path.join(self.directory, filename)
+
+    def _open(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self.active_path = self.file_path()
+        self.active = gzip.open(self.active_path + ".part", "wb", compresslevel=6)
+        self._write("meta", json.dumps(dict(rate=self.rate, worker=WORKER_NAME, pid=os.getpid())).encode("utf8"))
+
+    def _write(self, kind, payload):
+        if isinstance(kind, str):
+            kind = kind.encode("utf8")
+        if isinstance(payload, str):
+            payload = payload.encode("utf8")
+
+        self.active.write(HEADER.pack(time.time(), len(kind), len(payload)))
+        self.active.write(kind)
+        self.active.write(payload)
+
+    def _rotate(self):
+        if self.active:
+            self.active.close()
+            os.replace(self.active_path + ".part", self.active_path)
+            self.active = None
+            self.prune()
+
+    def record(self, kind, payloads):
+        if not payloads:
+            return
+
+        with self.lock:
+            if not self.active:
+                self._open()
+
+            for payload in payloads:
+                self._write(kind, payload)
+
+            # Compressed bytes written so far.
+            if self.active.fileobj.tell() >= self.file_bytes:
+                self._rotate()
+
+    def prune(self):
+        paths = sorted(
+            (os.path.join(self.directory, filename) for filename in os.listdir(self.directory) if filename.endswith(".gz")),
+            key=os.path.getmtime
+        )
+        total = sum(os.path.getsize(path) for path in paths)
+
+        while paths and total > self.max_bytes:
+            path = paths.pop(0)
+            total -= os.path.getsize(path)
+            os.remove(path)
+
+    def close(self):
+        with self.lock:
+            self._rotate()
+
+def read_capture(paths):
+    """
+    Yields (time, kind, payload) from capture files, file by file. A file
+    cut short by a crash is read up to the last whole record.
+    """
+    for path in paths:
+        try:
+            with gzip.open(path, "rb") as f:
+                while True:
+                    header = f.read(HEADER.size)
+                    if len(header) < HEADER.size:
+                        break
+
+                    seen, kind_length, payload_length = HEADER.unpack(header)
+                    kind = f.read(kind_length).decode("utf8")
+                    payload = f.read(payload_length)
+                    if len(payload) < payload_length:
+                        break
+
+                    yield seen, kind, payload
+        except (EOFError, OSError):
+            print(f"{path} is truncated, skipping the rest of it.", flush=True)
+
+def capture_files(directory):
+    return sorted(
+        os.path.join(directory, filename)
+        for filename in os.listdir(directory)
+        if filename.endswith(".gz") or filename.endswith(".gz.part")
+    )
+
+capture = Capture()
+atexit.register(capture.close)
@@ -1,27 +1,40 @@
 import os
-import sys
 import time
-import datetime
 import threading
 import collections
 import traceback
-import random
 import json
 
+from redis.exceptions import ConnectionError as RedisConnectionError, TimeoutError as RedisTimeoutError
+
 from apipipeline import sentry_sdk
+from apipipeline import instrumentation
+from apipipeline.capture import capture
 from apipipeline.connections import create_tumblr, create_redis
+from apipipeline.instrumentation import timed
+from apipipeline.jobs import POSTS_PER_PAGE, decode_job, job_end, is_cursor_job
+from apipipeline.keys import IMPORT_QUEUE, IMPORT_WORKING, IMPORT_HEARTBEAT, POSTS_QUEUE, WORK_STATS
+from apipipeline.negcache import NegativeCache, purge_jobs
+from apipipeline.ratelimit import RateLimiter
+from apipipeline.spool import Spool
+from apipipeline.utils import encode_payload, project_fields
+
+# Above this many queued posts fetched pages go to the local spool instead.
+QUEUE_HIGH_WATER = int(os.environ.get("QUEUE_HIGH_WATER", 50000))
 
-class ReturnJob(Exception):
+REDIS_DOWN = (RedisConnectionError, RedisTimeoutError)
+
+class DeadBlog(Exception):
     pass
 
 FETCH_SCRIPT = """
 redis.replicate_commands()
 local time = redis.call('TIME')[1]
-local item = redis.call('SPOP', 'tumblr:queue:import')
+local item = redis.call('SPOP', KEYS[1])
 
 if item then
     local new_item = time .. ';' .. item
-    local updated = redis.call('SADD', 'tumblr:queue:import:working', new_item)
+    local updated = redis.call('SADD', KEYS[2], new_item)
 else
     return nil, nil
 end
@@ -32,22 +45,57 @@ class BlogManager(object):
     def __init__(self):
         self.tumblr = create_tumblr()
         self.redis = create_redis()
+
+        # Out of quota waits can outlast the repusher's idle limit.
+        self.tumblr.on_wait = self.heartbeat
+        self.negative = NegativeCache(self.redis)
         self.bad = collections.defaultdict(lambda: 0)
 
-        self.last_request = time.time()
+        # Every key in the pool gets its own share of requests.
+        self.limiter = RateLimiter(float(os.environ.get("REQUESTS_PER_SECOND", 5)) * len(self.tumblr))
         self.running = True
+        self.local = threading.local()
         self._fetch_item = None
 
+        self.spool = Spool()
+        self._queue_len = None
+        self._queue_checked = 0
+
     def fetch_item(self):
         if not self._fetch_item:
             self._fetch_item = self.redis.register_script(FETCH_SCRIPT)
 
-        return self._fetch_item()
+        return self._fetch_item(keys=[IMPORT_QUEUE, IMPORT_WORKING])
+
+    def heartbeat(self, position=None):
+        # Tell the repusher this thread's job is alive and where to resume it, an offset or a before cursor.
+        working = getattr(self.local, "working", None)
+        if not working:
+            return
+
+        if position is not None:
+            self.local.position = position
+
+        try:
+            self.redis.hset(IMPORT_HEARTBEAT, working, "%s;%s" % (time.time(), self.local.position))
+        except REDIS_DOWN:
+            pass
+
+    def queue_has_room(self):
+        # Every thread asks before every page, only check every few seconds.
+        if time.time() - self._queue_checked > 5:
+            try:
+                self._queue_len = self.redis.scard(POSTS_QUEUE)
+            except REDIS_DOWN:
+                self._queue_len = None
+            self._queue_checked = time.time()
+
+        return self._queue_len is not None and self._queue_len <= QUEUE_HIGH_WATER
 
     def log(self, *args):
         print(f"[{threading.current_thread().name}]", *args, flush=True)
 
-    def add(self, data, oldest=None):
+    def prepare(self, data, oldest=None):
         # Set timestamps.
         posted = float(data.get("timestamp", 0.0))
         if not oldest:
@@ -55,48 +103,83 @@ class BlogManager(object):
 
         # Don't queue up the post if the post is too old.
         if oldest > posted:
-            return False
+            return None
 
-        # Queue post and continue.
-        self.redis.sadd("tumblr:queue:posts", json.dumps(data))
+        # Strip unused fields and compress the post.
+        project_fields(data)
+        return encode_payload(data)
 
-        return True
+    def enqueue(self, payloads):
+        if not payloads:
+            return
 
-    def get_posts(self, name, offset):
-        # Sleep if the queue is larger than 50K posts.
-        queue_len = self.redis.scard("tumblr:queue:posts")
-        while queue_len > 50000:
-            self.log(f"Queue is at {queue_len}.")
-            time.sleep(5)
-            queue_len = self.redis.scard("tumblr:queue:posts")
+        capture.record(POSTS_QUEUE, capture.sample(payloads))
 
-        # Limit us to 5 req/s
-        last_delta = (time.time() - self.last_request)
-        if last_delta < 0.20:
-            time.sleep(0.20 - last_delta)
+        if self.queue_has_room():
+            try:
+                self.redis.sadd(POSTS_QUEUE, *payloads)
+                return
+            except REDIS_DOWN:
+                self._queue_len = None
+
+        # The queue is full or down, keep the page on disk until there is room.
+        with timed("spool"):
+            self.spool.write(POSTS_QUEUE, payloads)
+
+    def get_posts(self, name, offset=None, before=None):
+        # Only wait on the queue once the local spool is full as well.
+        if not self.queue_has_room() and self.spool.full:
+            with timed("backpressure_sleep"):
+                while not self.queue_has_room() and self.spool.full:
+                    self.log(f"Queue is at {self._queue_len}, spool is full.")
+                    self.heartbeat()
+                    time.sleep(5)
+
+        # Limit us to 5 req/s per key across all threads.
+        self.limiter.wait()
+
+        with timed("api_wait"):
+            if before:
+                response = self.tumblr.posts(name, before=before, limit=POSTS_PER_PAGE)
+            else:
+                response = self.tumblr.posts(name, offset=offset or 0, limit=POSTS_PER_PAGE)
 
-        # Update the time and return the posts.
-        self.last_request = time.time()
+        # Before process strips fields from the posts.
+        if capture.sample([response]):
+            capture.record("api:posts", [json.dumps(dict(name=name, offset=offset, before=before, response=response))])
 
-        return self.tumblr.posts(name, offset=offset)
+        return response
 
-    def process(self, name, offset, last_crawl):
+    def process(self, name, offset, last_crawl, before=None, skip=()):
+        """
+        Fetch and queue one page, by offset or by before cursor. Posts with
+        an id in skip are already queued. Returns the number of posts queued
+        and the posts of the page.
+        """
         added_posts = 0
 
         if self.bad[name] >= 15:
             if self.bad[name] != 999:
                 self.log(f"All posts crawled for {name}. (Probarly)")
                 self.bad[name] = 999
-            return
+            return 0, []
+
+        # Another thread may have found the blog gone since this job was queued.
+        try:
+            if self.negative.is_dead(name):
+                raise DeadBlog
+        except REDIS_DOWN:
+            pass
 
         # Get posts of the offset.
-        posts_response = self.get_posts(name, offset)
+        posts_response = self.get_posts(name, offset, before)
         post_status = posts_response.get("meta", {}).get("status", None) 
 
         # Handle errors
         if post_status == 404:
             self.log(posts_response)
-            raise ReturnJob
+            self.blog_gone(name)
+            raise DeadBlog
 
         if (
             post_status in (502, 503, 429)
@@ -104,52 +187,184 @@ class BlogManager(object):
         ):
             self.log(posts_response)
             time.sleep(10)
-            self.process(name, offset, last_crawl)
-            return
+            return self.process(name, offset, last_crawl, before, skip)
 
-        # Add the posts one by one.
+        # Add the page in one go.
         posts = posts_response["posts"]
+        payloads = []
         for post in posts:
-            post_ok = self.add(post, last_crawl)
-            if post_ok:
+            if post.get("id") in skip:
+                continue
+
+            payload = self.prepare(post, last_crawl)
+            if payload:
+                payloads.append(payload)
                 added_posts += 1
             else:
                 self.bad[name] += 1
-                continue
+
+        with timed("enqueue"):
+            self.enqueue(payloads)
 
         # Print every time a fetch is completed and pushed.
         self.log(f"{len(posts)} @ '{name}'.")
 
         # This is not secure but have some honor!
-        self.redis.hincrby("tumblr:work_stats", os.environ.get("WORKER_NAME", "anonymous"), len(posts))
+        try:
+            self.redis.hincrby(WORK_STATS, os.environ.get("WORKER_NAME", "anonymous"), len(posts))
+        except REDIS_DOWN:
+            pass
+
+        return added_posts, posts
+
+    def blog_gone(self, name):
+        # Every other range of the blog would 404 as well.
+        try:
+            self.negative.mark(name, "404")
+            purged = purge_jobs(self.redis, name)
+        except REDIS_DOWN:
+            return
+
+        self.log(f"{name} is gone, dropped {purged} queued jobs.")
+
+    def walk_offsets(self, job, last_crawl):
+        # Walk the range page by page on the same blog.
+        for offset in range(int(job["offset"]), job_end(job), POSTS_PER_PAGE):
+            if not self.running:
+                return False
+
+            added_posts, _ = self.process(job["name"], offset, last_crawl)
+            self.heartbeat(offset + POSTS_PER_PAGE)
+
+            # Posts are newest first, an empty or all-old page ends the blog.
+            if not added_posts:
+                break
+
+        return True
+
+    def walk_cursor(self, job, last_crawl):
+        # Each page asks for posts before the oldest one of the previous page.
+        # before is exclusive and posts can share a second, so the cursor stays
+        # one second later and the posts of that second are skipped instead.
+        before = int(job["before"])
+        skip = set()
+
+        while True:
+            if not self.running:
+                return False
+
+            added_posts, posts = self.process(job["name"], None, last_crawl, before, skip)
+            if not posts:
+                break
+
+            fresh = [post for post in posts if post.get("id") not in skip]
+            oldest = min(int(post["timestamp"]) for post in posts)
+
+            if not fresh:
+                # A whole page from one second, step past it.
+                before, skip = oldest, set()
+            elif before == oldest + 1:
+                skip.update(post.get("id") for post in posts if int(post["timestamp"]) == oldest)
+            else:
+                before = oldest + 1
+                skip = set(post.get("id") for post in posts if int(post["timestamp"]) == oldest)
+
+            self.heartbeat(before)
+
+            # Stop right at the previous crawl's newest post.
+            if added_posts < len(fresh):
+                break
+
+        return True
+
+    def process_job(self, job, working):
+        self.local.working = working
+        self.local.position = job["before"] if is_cursor_job(job) else int(job["offset"])
+        last_crawl = float(job["last_crawl"])
+
+        try:
+            try:
+                if is_cursor_job(job):
+                    finished = self.walk_cursor(job, last_crawl)
+                else:
+                    finished = self.walk_offsets(job, last_crawl)
+            except DeadBlog:
+                # Done with, the negative cache decides when the blog is tried again.
+                finished = True
+
+            if not finished:
+                # Leave the job in the working set, the repusher resumes it.
+                return
+
+            pipe = self.redis.pipeline(transaction=False)
+            pipe.srem(IMPORT_WORKING, working)
+            pipe.hdel(IMPORT_HEARTBEAT, working)
+            pipe.execute()
+        finally:
+            self.local.working = None
 
     def work(self):
+        started_prefix = "%s;%s"
+
         while self.running:
-            if self.redis.scard("tumblr:queue:import") == 0:
+            try:
+                claimed = self.fetch_item()
+            except REDIS_DOWN:
+                self.log("Redis is unreachable, retrying.")
+                time.sleep(5)
+                continue
+
+            if not claimed:
                 time.sleep(1)
                 continue
 
-            started_prefix = "%s;%s"
+            started_time, raw_item = claimed
+
+            working = started_prefix % (started_time, raw_item)
 
             try:
-                started_time, raw_item = self.fetch_item()
-                item = json.loads(raw_item)
-            except (TypeError, json.decoder.JSONDecodeError):
+                job = decode_job(raw_item)
+            except (TypeError, ValueError):
+                # Nothing can resume it, keep it from circling through the repusher.
+                self.log(f"Dropping undecodable job {raw_item!r}.")
+                try:
+                    self.redis.srem(IMPORT_WORKING, working)
+                except REDIS_DOWN:
+                    pass
                 continue
 
             try:
-                self.process(item["name"], item["offset"], float(item["last_crawl"]))
-                self.redis.srem("tumblr:queue:import:working", started_prefix % (started_time, raw_item))
-            except ReturnJob:
+                self.process_job(job, working)
+            except:
+                if sentry_sdk:
+                    sentry_sdk.capture_exception()
+                traceback.print_exc()
+
+    def drain_spool(self):
+        while self.running:
+            try:
+                if self.spool.size and self.queue_has_room():
+                    with timed("spool_drain"):
+                        replayed = self.spool.drain_segment(self.redis)
+
+                    if replayed is not None:
+                        self.log(f"Replayed {replayed} spooled posts.")
+                        # Look at the queue again before the next segment.
+                        self._queue_checked = 0
+                        continue
+            except REDIS_DOWN:
                 pass
             except:
                 if sentry_sdk:
                     sentry_sdk.capture_exception()
                 traceback.print_exc()
 
+            time.sleep(5)
+
 if __name__ == "__main__":
     workers = []
     blog_manager = BlogManager()
+    instrumentation.start("fetcher", blog_manager.redis)
 
     # Thread startup
     for x in range(0, int(os.environ.get("WORKERS", 2))):
@@ -157,6 +372,11 @@ if __name__ == "__main__":
         t.start()
         workers.append(t)
 
+    # Replays pages spooled while the queue was full or down.
+    t = threading.Thread(target=blog_manager.drain_spool, name="spool")
+    t.start()
+    workers.append(t)
+
     try:
         while blog_manager.running:
             # If the any thread is dead, stop running.
@@ -1,32 +1,53 @@
 import os
 
-import pytumblr
 from redis import ConnectionPool, StrictRedis
 
-redis_pool = ConnectionPool(
+redis_kwargs = dict(
     host=os.environ.get('REDIS_PORT_6379_TCP_ADDR', os.environ.get('REDIS_HOST', '127.0.0.1')),
     port=int(os.environ.get('REDIS_PORT_6379_TCP_PORT', os.environ.get('REDIS_PORT', 6379))),
     db=int(os.environ.get('REDIS_DB', 0)),
-    decode_responses=True
 )
 
+redis_pool = ConnectionPool(decode_responses=True, **redis_kwargs)
+
+# Compressed queue payloads are binary and have to be read without decoding.
+redis_binary_pool = ConnectionPool(decode_responses=False, **redis_kwargs)
+
+# Comma separated host:port startup nodes. Switches every client to Redis Cluster.
+REDIS_CLUSTER = os.environ.get("REDIS_CLUSTER_NODES", "")
+cluster_clients = {}
+
 def create_tumblr():
-    if "TUMBLR_TOKEN_SECRET" in os.environ:
-        return pytumblr.TumblrRestClient(
-            os.environ.get("TUMBLR_CONSUMER_KEY"),
-            os.environ.get("TUMBLR_CONSUMER_SECRET"),
-            os.environ.get("TUMBLR_TOKEN"),
-            os.environ.get("TUMBLR_TOKEN_SECRET")
-        )
-    elif "TUMBLR_CONSUMER_SECRET" in os.environ:
-        return pytumblr.TumblrRestClient(
-            os.environ.get("TUMBLR_CONSUMER_KEY"),
-            os.environ.get("TUMBLR_CONSUMER_SECRET")
-        )
-    else:
-        return pytumblr.TumblrRestClient(
-            os.environ.get("TUMBLR_CONSUMER_KEY")
-        )
-
-def create_redis():
+    # Imported here, pytumblr and requests are slow to import and only fetchers need them.
+    from apipipeline.credentials import TumblrPool, load_credentials
+
+    return TumblrPool(load_credentials())
+
+def create_cluster(binary=False):
+    # Cluster clients keep a pool per node, share one per decoding mode.
+    if binary not in cluster_clients:
+        from redis.cluster import RedisCluster, ClusterNode
+
+        nodes = []
+        for node in REDIS_CLUSTER.split(","):
+            host, _, port = node.strip().partition(":")
+            nodes.append(ClusterNode(host, int(port or 6379)))
+
+        cluster_clients[binary] = RedisCluster(startup_nodes=nodes, decode_responses=not binary)
+
+    return cluster_clients[binary]
+
+def create_redis(binary=False):
+    if REDIS_CLUSTER:
+        return create_cluster(binary)
+
+    if binary:
+        return StrictRedis(connection_pool=redis_binary_pool)
+
     return StrictRedis(connection_pool=redis_pool)
+
+def reset_after_fork():
+    # ConnectionPool notices a new pid by itself. Cluster clients don't, build new ones in the child.
+    cluster_clients.clear()
+
+os.register_at_fork(after_in_child=reset_after_fork)
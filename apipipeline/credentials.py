@@ -0,0 +1,215 @@
+import os
+import json
+import time
+import random
+import hashlib
+import datetime
+import urllib.parse
+
+import pytumblr
+import requests
+from requests.adapters import HTTPAdapter
+from requests.exceptions import TooManyRedirects
+from pytumblr.request import TumblrRequest
+from redis.exceptions import ConnectionError as RedisConnectionError, TimeoutError as RedisTimeoutError
+
+from apipipeline.connections import create_redis
+from apipipeline.instrumentation import timed
+from apipipeline.keys import api_key
+
+# Defaults for newly registered API consumers. Override per key in the credentials file.
+HOURLY_LIMIT = int(os.environ.get("TUMBLR_HOURLY_LIMIT", 1000))
+DAILY_LIMIT = int(os.environ.get("TUMBLR_DAILY_LIMIT", 5000))
+COOLDOWN = int(os.environ.get("TUMBLR_KEY_COOLDOWN", 900))
+
+# Statuses that take a key out of rotation for a cool-down. 401 and 403 only
+# count with a key-level error code, a private or restricted blog answers them too.
+THROTTLED_STATUS = 429
+AUTH_STATUSES = (401, 403)
+KEY_ERROR_CODES = [int(code) for code in os.environ.get("TUMBLR_KEY_ERROR_CODES", "1016").split(",") if code]
+
+class SessionTumblrRequest(TumblrRequest):
+    """
+    TumblrRequest that keeps one keep-alive session around and always asks
+    the API for a compressed response.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.session = requests.Session()
+        self.headers["Accept-Encoding"] = "gzip, deflate"
+
+        # Enough pooled connections for every thread sharing this client.
+        adapter = HTTPAdapter(pool_maxsize=int(os.environ.get("HTTP_POOL_SIZE", 32)))
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def get(self, url, params):
+        url = self.host + url
+        if params:
+            url = url + "?" + urllib.parse.urlencode(params)
+
+        try:
+            resp = self.session.get(url, allow_redirects=False, headers=self.headers, auth=self.oauth)
+        except TooManyRedirects as e:
+            resp = e.response
+
+        return self.json_parse(resp)
+
+def load_credentials():
+    """
+    Key sets come from the JSON file at TUMBLR_CREDENTIALS_FILE, JSON in
+    TUMBLR_CREDENTIALS or the single set of TUMBLR_* variables, in that order.
+    Each set is a dict with consumer_key and optionally consumer_secret,
+    token, token_secret, hourly_limit and daily_limit.
+    """
+    if "TUMBLR_CREDENTIALS_FILE" in os.environ:
+        with open(os.environ["TUMBLR_CREDENTIALS_FILE"]) as f:
+            return json.load(f)
+
+    if "TUMBLR_CREDENTIALS" in os.environ:
+        return json.loads(os.environ["TUMBLR_CREDENTIALS"])
+
+    return [dict(
+        consumer_key=os.environ.get("TUMBLR_CONSUMER_KEY"),
+        consumer_secret=os.environ.get("TUMBLR_CONSUMER_SECRET", ""),
+        token=os.environ.get("TUMBLR_TOKEN", ""),
+        token_secret=os.environ.get("TUMBLR_TOKEN_SECRET", ""),
+    )]
+
+class Credential(object):
+    def __init__(self, consumer_key, consumer_secret="", token="", token_secret="", hourly_limit=HOURLY_LIMIT, daily_limit=DAILY_LIMIT):
+        # Only a hash of the key ends up in Redis.
+        self.key_id = hashlib.sha1((consumer_key or "").encode("utf8")).hexdigest()[:12]
+        self.hourly_limit = hourly_limit
+        self.daily_limit = daily_limit
+
+        credentials = (consumer_key, consumer_secret or "", token or "", token_secret or "")
+        self.client = pytumblr.TumblrRestClient(*credentials)
+        self.client.request = SessionTumblrRequest(*credentials)
+
+    def usage_keys(self, now):
+        return (
+            api_key("%s:hour:%s" % (self.key_id, now.strftime("%Y%m%d%H"))),
+            api_key("%s:day:%s" % (self.key_id, now.strftime("%Y%m%d"))),
+            api_key("%s:cooldown" % self.key_id),
+        )
+
+class TumblrPool(object):
+    """
+    Drop-in for TumblrRestClient that sends every call through the key with
+    the most quota left. Usage, 429s and cool-downs are tracked in Redis so
+    every host sharing a key sees the same numbers.
+    """
+
+    def __init__(self, credentials, redis=None, on_wait=None):
+        self.credentials = [Credential(**credential) for credential in credentials]
+        self.redis = redis or create_redis()
+
+        # Called before every quota sleep, fetchers use it to keep their job's heartbeat fresh.
+        self.on_wait = on_wait
+
+    def __len__(self):
+        return len(self.credentials)
+
+    def headroom(self):
+        now = datetime.datetime.utcnow()
+        keys = []
+        for credential in self.credentials:
+            keys.extend(credential.usage_keys(now))
+
+        try:
+            values = self.redis.mget(keys)
+        except (RedisConnectionError, RedisTimeoutError):
+            # Keep fetching on local limits while Redis is down.
+            values = [None] * len(keys)
+
+        result = []
+
+        for index, credential in enumerate(self.credentials):
+            hour_used, day_used, cooldown = values[index * 3:index * 3 + 3]
+            if cooldown:
+                continue
+
+            result.append((min(
+                credential.hourly_limit - int(hour_used or 0),
+                credential.daily_limit - int(day_used or 0)
+            ), credential))
+
+        return result
+
+    def choose(self):
+        while True:
+            available = [item for item in self.headroom() if item[0] > 0]
+            if available:
+                best = max(headroom for headroom, _ in available)
+                return random.choice([credential for headroom, credential in available if headroom == best])
+
+            # Every key is cooling down or out of quota.
+            print("No API key has quota left, waiting.", flush=True)
+            if self.on_wait:
+                self.on_wait()
+
+            with timed("quota_sleep"):
+                time.sleep(30)
+
+    def key_failed(self, response, status):
+        if status == THROTTLED_STATUS:
+            return True
+
+        if status not in AUTH_STATUSES:
+            return False
+
+        errors = response.get("errors") or []
+        return any(isinstance(error, dict) and error.get("code") in KEY_ERROR_CODES for error in errors)
+
+    def record(self, credential, status, failed=False):
+        hour_key, day_key, cooldown_key = credential.usage_keys(datetime.datetime.utcnow())
+
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.incr(hour_key)
+        pipe.expire(hour_key, 3600 * 2)
+        pipe.incr(day_key)
+        pipe.expire(day_key, 86400 * 2)
+
+        if failed:
+            errors_key = api_key("%s:%s" % (credential.key_id, status))
+            pipe.incr(errors_key)
+            pipe.expire(errors_key, 3600)
+            pipe.set(cooldown_key, status, ex=COOLDOWN)
+
+        try:
+            pipe.execute()
+        except (RedisConnectionError, RedisTimeoutError):
+            pass
+
+    def call(self, method, *args, **kwargs):
+        # A throttled key is benched and the call retried on the next best one.
+        for attempt in range(len(self.credentials)):
+            credential = self.choose()
+            response = getattr(credential.client, method)(*args, **kwargs)
+
+            status = None
+            failed = False
+            if isinstance(response, dict):
+                status = response.get("meta", {}).get("status")
+                failed = self.key_failed(response, status)
+
+            self.record(credential, status, failed)
+
+            # Anything else, blog-level 401s and 403s included, is the caller's to handle.
+            if not failed:
+                break
+
+            print(f"Key {credential.key_id} got {status}, cooling down for {COOLDOWN} seconds.", flush=True)
+
+        return response
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+
+        def method(*args, **kwargs):
+            return self.call(name, *args, **kwargs)
+
+        return method
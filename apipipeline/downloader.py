@@ -0,0 +1,316 @@
+"""
+Bulk media downloader for create_urlist output.
+
+    python3 apipipeline/downloader.py urllists/photo_original urllists/body --dir media
+    python3 apipipeline/downloader.py --redis tumblr:queue:media --dir media
+
+Files are stored by content as <dir>/<sha256[:2]>/<sha256[2:4]>/<sha256><ext>.
+<dir>/index.sqlite3 remembers every finished url, a restarted run skips them.
+Failed urls are not recorded and retried on the next run. With --redis they
+go back into the set, along with anything popped but not yet downloaded when
+the run stops.
+"""
+import os
+import re
+import sys
+import json
+import time
+import random
+import sqlite3
+import asyncio
+import hashlib
+import argparse
+import functools
+import collections
+
+from urllib.parse import urlparse
+
+import aiohttp
+
+from apipipeline import instrumentation
+from apipipeline.instrumentation import timed
+
+DOWNLOAD_DIR = os.environ.get("DOWNLOAD_DIR", "media")
+CONCURRENCY = int(os.environ.get("DOWNLOAD_CONCURRENCY", 64))
+PER_HOST = int(os.environ.get("DOWNLOAD_PER_HOST", 16))
+TIMEOUT = float(os.environ.get("DOWNLOAD_TIMEOUT", 60))
+RETRIES = int(os.environ.get("DOWNLOAD_RETRIES", 3))
+STATS_INTERVAL = float(os.environ.get("STATS_INTERVAL", 60))
+
+BATCH_SIZE = 500
+CHUNK_SIZE = 64 * 1024
+
+# Gone for good, recorded so they are not asked for again.
+MISSING_STATUSES = (403, 404, 410)
+
+EXTENSION = re.compile(r"^\.[a-z0-9]{1,5}$")
+
+class DownloadIndex(object):
+    """
+    url -> sha256 of every finished download, in SQLite next to the files.
+    Writes are buffered and committed in batches.
+    """
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.execute("CREATE TABLE IF NOT EXISTS downloads (url TEXT PRIMARY KEY, sha256 TEXT, size INTEGER, status TEXT)")
+        self.pending = []
+
+    def finished(self, urls):
+        found = set()
+        for index in range(0, len(urls), BATCH_SIZE):
+            batch = urls[index:index + BATCH_SIZE]
+            query = "SELECT url FROM downloads WHERE url IN (%s)" % ",".join("?" * len(batch))
+            found.update(row[0] for row in self.db.execute(query, batch))
+
+        return found
+
+    def record(self, url, sha256, size, status):
+        self.pending.append((url, sha256, size, status))
+        if len(self.pending) >= BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            self.db.executemany("INSERT OR REPLACE INTO downloads VALUES (?, ?, ?, ?)", self.pending)
+            self.db.commit()
+            self.pending = []
+
+    def close(self):
+        self.flush()
+        self.db.close()
+
+def read_url_files(paths):
+    # urllists files have a "url" header, variant index lines carry widths after the url.
+    for path in paths:
+        with open(path) as f:
+            for line in f:
+                url = line.split(" ", 1)[0].strip()
+                if url and url != "url":
+                    yield url
+
+class RedisUrls(object):
+    """
+    urls popped from a Redis set in batches. Popped urls stay pending until
+    done() is called for them, restore() adds the rest back to the set.
+    """
+
+    def __init__(self, key, redis=None):
+        from apipipeline.connections import create_redis
+
+        self.key = key
+        self.redis = redis or create_redis()
+        self.pending = set()
+
+    async def batches(self):
+        # redis-py blocks, keep it off the event loop.
+        loop = asyncio.get_event_loop()
+        while True:
+            urls = await loop.run_in_executor(None, functools.partial(self.redis.spop, self.key, count=BATCH_SIZE))
+            if not urls:
+                return
+
+            self.pending.update(urls)
+            yield urls
+
+    def done(self, url):
+        self.pending.discard(url)
+
+    def restore(self):
+        if self.pending:
+            self.redis.sadd(self.key, *self.pending)
+            print(f"Returned {len(self.pending)} urls to {self.key}.", flush=True)
+            self.pending.clear()
+
+class Downloader(object):
+    def __init__(self, directory=DOWNLOAD_DIR, concurrency=CONCURRENCY, per_host=PER_HOST, timeout=TIMEOUT, retries=RETRIES):
+        self.directory = directory
+        self.concurrency = concurrency
+        self.per_host = per_host
+        self.timeout = timeout
+        self.retries = retries
+
+        self.temp_dir = os.path.join(directory, "tmp")
+        os.makedirs(self.temp_dir, exist_ok=True)
+        self.index = DownloadIndex(os.path.join(directory, "index.sqlite3"))
+
+        self.stats = collections.Counter()
+        self.errors = collections.Counter()
+        self.started = None
+        self.source = None
+
+    def storage_path(self, sha256, url):
+        extension = os.path.splitext(urlparse(url).path)[1].lower()
+        if not EXTENSION.match(extension):
+            extension = ""
+
+        return os.path.join(self.directory, sha256[:2], sha256[2:4], sha256 + extension)
+
+    def store(self, temp_path, sha256, url):
+        path = self.storage_path(sha256, url)
+        if os.path.exists(path):
+            # Same content under another url.
+            os.remove(temp_path)
+            self.stats["duplicates"] += 1
+            return
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(temp_path, path)
+
+    async def fetch(self, session, url, worker_id):
+        temp_path = os.path.join(self.temp_dir, "%d.part" % worker_id)
+
+        for attempt in range(self.retries):
+            if attempt:
+                await asyncio.sleep(2 ** attempt + random.random())
+
+            try:
+                async with session.get(url) as response:
+                    if response.status in MISSING_STATUSES:
+                        self.stats["missing"] += 1
+                        return None, 0, "missing"
+
+                    if response.status != 200:
+                        self.errors[str(response.status)] += 1
+                        continue
+
+                    # Small writes to local disk, not worth a thread per chunk.
+                    digest = hashlib.sha256()
+                    size = 0
+                    with open(temp_path, "wb") as f:
+                        async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                            digest.update(chunk)
+                            f.write(chunk)
+                            size += len(chunk)
+
+                self.stats["bytes"] += size
+                self.stats["files"] += 1
+                sha256 = digest.hexdigest()
+                self.store(temp_path, sha256, url)
+                return sha256, size, "ok"
+            except asyncio.TimeoutError:
+                self.errors["timeout"] += 1
+            except aiohttp.ClientError as e:
+                self.errors[type(e).__name__] += 1
+
+        self.stats["failed"] += 1
+        return None, 0, None
+
+    async def worker(self, session, queue, worker_id):
+        while True:
+            url = await queue.get()
+            if url is None:
+                return
+
+            with timed("download"):
+                sha256, size, status = await self.fetch(session, url, worker_id)
+
+            if status:
+                self.index.record(url, sha256, size, status)
+                if self.source:
+                    self.source.done(url)
+
+    async def feed(self, urls, queue):
+        batch = []
+
+        async def put_batch():
+            finished = self.index.finished(batch)
+            self.stats["skipped"] += len(finished)
+            for url in batch:
+                if url not in finished:
+                    await queue.put(url)
+                elif self.source:
+                    self.source.done(url)
+            batch.clear()
+
+        if isinstance(urls, RedisUrls):
+            self.source = urls
+            async for batch in urls.batches():
+                await put_batch()
+            return
+
+        for url in urls:
+            batch.append(url)
+            if len(batch) >= BATCH_SIZE:
+                await put_batch()
+
+        await put_batch()
+
+    def summary(self):
+        seconds = max(time.time() - self.started, 0.001)
+
+        return dict(
+            seconds=round(seconds, 1),
+            files=self.stats["files"],
+            files_per_sec=round(self.stats["files"] / seconds, 2),
+            mbytes_per_sec=round(self.stats["bytes"] / seconds / 1024 / 1024, 2),
+            skipped=self.stats["skipped"],
+            duplicates=self.stats["duplicates"],
+            missing=self.stats["missing"],
+            failed=self.stats["failed"],
+            errors=dict(self.errors),
+        )
+
+    async def report(self):
+        while True:
+            await asyncio.sleep(STATS_INTERVAL)
+            print(json.dumps(dict(stats="downloader", **self.summary())), flush=True)
+
+    async def run(self, urls):
+        self.started = time.time()
+        queue = asyncio.Queue(maxsize=self.concurrency * 4)
+
+        # One pool of keep-alive connections, capped per media host.
+        connector = aiohttp.TCPConnector(limit=self.concurrency, limit_per_host=self.per_host, ttl_dns_cache=300)
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            workers = [asyncio.ensure_future(self.worker(session, queue, worker_id)) for worker_id in range(self.concurrency)]
+            reporter = asyncio.ensure_future(self.report())
+
+            try:
+                await self.feed(urls, queue)
+                for _ in workers:
+                    await queue.put(None)
+                await asyncio.gather(*workers)
+            finally:
+                reporter.cancel()
+                for worker in workers:
+                    worker.cancel()
+                self.index.flush()
+
+                if self.source:
+                    await asyncio.get_event_loop().run_in_executor(None, self.source.restore)
+
+        return self.summary()
+
+    def close(self):
+        self.index.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Download media urls into content-addressed storage.")
+    parser.add_argument("files", nargs="*", help="urllists files to download.")
+    parser.add_argument("--redis", help="Pop urls from this Redis set instead.")
+    parser.add_argument("--dir", default=DOWNLOAD_DIR)
+    parser.add_argument("--concurrency", type=int, default=CONCURRENCY)
+    parser.add_argument("--per-host", type=int, default=PER_HOST)
+    args = parser.parse_args()
+
+    if not args.files and not args.redis:
+        parser.error("Give urllists files or --redis.")
+
+    urls = RedisUrls(args.redis) if args.redis else read_url_files(args.files)
+    downloader = Downloader(args.dir, args.concurrency, args.per_host)
+    instrumentation.start("downloader")
+
+    loop = asyncio.get_event_loop()
+    try:
+        print(json.dumps(dict(stats="downloader", **loop.run_until_complete(downloader.run(urls)))), flush=True)
+    except KeyboardInterrupt:
+        print("Stopping!")
+        sys.exit(1)
+    finally:
+        # The run is cut short on Ctrl-C, put back what it popped.
+        if args.redis:
+            urls.restore()
+        downloader.close()
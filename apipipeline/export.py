@@ -0,0 +1,223 @@
+"""
+Incremental Parquet export of posts and blogs for analytics.
+
+    python3 apipipeline/export.py posts_warehouse blogs --dir export
+
+Each run picks up after the highest id exported so far and writes new
+part-<first id>-<last id>.parquet files under <dir>/<table>/. Commonly used
+fields are promoted to columns, the full JSON stays in the data column.
+"""
+import os
+import re
+import sys
+import json
+import argparse
+import datetime
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+from sqlalchemy import text
+
+from apipipeline.model import get_engine
+
+EXPORT_DIR = os.environ.get("EXPORT_DIR", "export")
+BATCH_ROWS = int(os.environ.get("EXPORT_BATCH_ROWS", 20000))
+FILE_ROWS = int(os.environ.get("EXPORT_FILE_ROWS", 1000000))
+STATE_FILE = "_export_state.json"
+
+def post_schema():
+    return pyarrow.schema([
+        ("id", pyarrow.int64()),
+        ("author_id", pyarrow.int64()),
+        ("tumblr_id", pyarrow.int64()),
+        ("blog_name", pyarrow.string()),
+        ("type", pyarrow.string()),
+        ("timestamp", pyarrow.timestamp("s")),
+        ("tags", pyarrow.list_(pyarrow.string())),
+        ("note_count", pyarrow.int64()),
+        ("reblogged_root_id", pyarrow.int64()),
+        ("photo_urls", pyarrow.list_(pyarrow.string())),
+        ("data", pyarrow.string()),
+    ])
+
+def blog_schema():
+    return pyarrow.schema([
+        ("id", pyarrow.int64()),
+        ("tumblr_uid", pyarrow.string()),
+        ("name", pyarrow.string()),
+        ("updated", pyarrow.timestamp("s")),
+        ("last_crawl_update", pyarrow.timestamp("s")),
+        ("posts", pyarrow.int64()),
+        ("title", pyarrow.string()),
+        ("data", pyarrow.string()),
+    ])
+
+def to_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+def photo_urls(data):
+    urls = [photo["original_size"]["url"] for photo in data.get("photos", []) if "original_size" in photo]
+    if data.get("link_image"):
+        urls.append(data["link_image"])
+
+    return urls
+
+def post_row(row):
+    row_id, author_id, raw = row
+    data = json.loads(raw)
+    timestamp = to_int(data.get("timestamp"))
+
+    return dict(
+        id=row_id,
+        author_id=author_id,
+        tumblr_id=to_int(data.get("id")),
+        blog_name=data.get("blog_name"),
+        type=data.get("type"),
+        timestamp=datetime.datetime.utcfromtimestamp(timestamp) if timestamp is not None else None,
+        tags=[str(tag) for tag in data.get("tags", [])],
+        note_count=to_int(data.get("note_count")),
+        reblogged_root_id=to_int(data.get("reblogged_root_id")),
+        photo_urls=photo_urls(data),
+        data=raw,
+    )
+
+def blog_row(row):
+    row_id, tumblr_uid, name, updated, last_crawl_update, raw = row
+    data = json.loads(raw)
+
+    return dict(
+        id=row_id,
+        tumblr_uid=tumblr_uid,
+        name=name,
+        updated=updated,
+        last_crawl_update=last_crawl_update,
+        posts=to_int(data.get("posts")),
+        title=data.get("title"),
+        data=raw,
+    )
+
+TABLES = {
+    "blogs": (
+        "SELECT id, tumblr_uid, name, updated, last_crawl_update, data::text FROM blogs "
+        "WHERE id > :last_id ORDER BY id LIMIT :limit",
+        blog_schema,
+        blog_row,
+    ),
+}
+
+# Everything else is a post table (posts, posts_warehouse).
+POST_QUERY = "SELECT id, author_id, data::text FROM {table} WHERE id > :last_id ORDER BY id LIMIT :limit"
+
+class TableExporter(object):
+    def __init__(self, table, directory):
+        if not re.match(r"^[a-z_][a-z0-9_]*$", table):
+            raise ValueError("Bad table name %r." % table)
+
+        if table in TABLES:
+            self.query, schema, self.to_row = TABLES[table]
+        else:
+            self.query, schema, self.to_row = POST_QUERY.format(table=table), post_schema, post_row
+
+        self.table = table
+        self.schema = schema()
+        self.directory = os.path.join(directory, table)
+        self.state_path = os.path.join(self.directory, STATE_FILE)
+
+        os.makedirs(self.directory, exist_ok=True)
+
+    def last_id(self):
+        if not os.path.exists(self.state_path):
+            return 0
+
+        with open(self.state_path) as f:
+            return json.load(f)["last_id"]
+
+    def save_state(self, last_id):
+        # Written after the part file is closed, a crash re-exports at most one part.
+        temp_path = self.state_path + ".tmp"
+        with open(temp_path, "w") as f:
+            json.dump({"last_id": last_id}, f)
+        os.replace(temp_path, self.state_path)
+
+    def batches(self, conn, last_id):
+        # Keyset pagination on the primary key, no OFFSET scans.
+        while True:
+            rows = conn.execute(text(self.query), last_id=last_id, limit=BATCH_ROWS).fetchall()
+            if not rows:
+                return
+
+            last_id = rows[-1][0]
+            yield last_id, pyarrow.RecordBatch.from_pylist([self.to_row(row) for row in rows], schema=self.schema)
+
+    def export(self):
+        start_id = self.last_id()
+        exported = 0
+        writer = None
+        first_id = None
+        file_rows = 0
+        temp_path = os.path.join(self.directory, "_writing.parquet")
+
+        def close_part(last_id):
+            writer.close()
+            os.replace(temp_path, os.path.join(self.directory, "part-%012d-%012d.parquet" % (first_id, last_id)))
+            self.save_state(last_id)
+
+        with get_engine().connect() as conn:
+            for last_id, batch in self.batches(conn, start_id):
+                if writer is None:
+                    first_id = batch.column(0)[0].as_py()
+                    writer = pyarrow.parquet.ParquetWriter(
+                        temp_path,
+                        self.schema,
+                        compression="zstd",
+                        use_dictionary=["blog_name", "type", "name"],
+                    )
+
+                writer.write_batch(batch)
+                exported += batch.num_rows
+                file_rows += batch.num_rows
+                print(f"{self.table}: {exported} rows exported, at id {last_id}.", flush=True)
+
+                if file_rows >= FILE_ROWS:
+                    close_part(last_id)
+                    writer = None
+                    file_rows = 0
+
+            if writer is not None:
+                close_part(last_id)
+
+        return exported
+
+def read_batches(directory, columns=None):
+    """
+    Iterate record batches of an exported table, oldest part first.
+    """
+    if not pyarrow:
+        raise RuntimeError("pyarrow is required to read exports.")
+
+    for filename in sorted(os.listdir(directory)):
+        if filename.startswith("part-") and filename.endswith(".parquet"):
+            parquet_file = pyarrow.parquet.ParquetFile(os.path.join(directory, filename))
+            for batch in parquet_file.iter_batches(columns=columns):
+                yield batch
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export tables to Parquet.")
+    parser.add_argument("tables", nargs="+", help="blogs, posts or posts_warehouse")
+    parser.add_argument("--dir", default=EXPORT_DIR)
+    args = parser.parse_args()
+
+    if not pyarrow:
+        print("pyarrow is required for exports. pip install pyarrow")
+        sys.exit(1)
+
+    for table in args.tables:
+        exported = TableExporter(table, args.dir).export()
+        print(f"{table}: done, {exported} new rows.", flush=True)
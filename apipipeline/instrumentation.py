@@ -0,0 +1,213 @@
+import os
+import sys
+import json
+import time
+import random
+import signal
+import threading
+import traceback
+import collections
+
+from contextlib import contextmanager
+
+from redis.exceptions import RedisError
+
+from apipipeline import sentry_sdk
+from apipipeline.keys import PROFILE_KEY
+
+WORKER_NAME = os.environ.get("WORKER_NAME", "anonymous")
+STATS_INTERVAL = float(os.environ.get("STATS_INTERVAL", 60))
+PROFILE_SECONDS = float(os.environ.get("PROFILE_SECONDS", 30))
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "/tmp")
+
+# Samples kept per stage and window. Older samples are replaced at random.
+RESERVOIR_SIZE = 4096
+
+def percentile(values, pct):
+    if not values:
+        return None
+
+    index = min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))
+    return values[index]
+
+class StageTimers(object):
+    """
+    Collects how long each stage of a worker takes. Summaries cover the time
+    since the previous summary.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.started = time.time()
+        self.samples = collections.defaultdict(list)
+        self.counts = collections.Counter()
+        self.totals = collections.defaultdict(float)
+
+    def record(self, stage, seconds):
+        with self.lock:
+            self.counts[stage] += 1
+            self.totals[stage] += seconds
+
+            samples = self.samples[stage]
+            if len(samples) < RESERVOIR_SIZE:
+                samples.append(seconds)
+            else:
+                index = random.randrange(self.counts[stage])
+                if index < RESERVOIR_SIZE:
+                    samples[index] = seconds
+
+    @contextmanager
+    def time(self, stage):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - started)
+
+    def summary(self, reset=True):
+        with self.lock:
+            window = time.time() - self.started
+            stages = {}
+
+            for stage, count in self.counts.items():
+                samples = sorted(self.samples[stage])
+                stages[stage] = {
+                    "count": count,
+                    "total": round(self.totals[stage], 4),
+                    "share": round(self.totals[stage] / window, 4) if window else None,
+                    "p50": round(percentile(samples, 50), 6),
+                    "p95": round(percentile(samples, 95), 6),
+                    "p99": round(percentile(samples, 99), 6),
+                    "max": round(samples[-1], 6),
+                }
+
+            if reset:
+                self.reset()
+
+        return {"window": round(window, 2), "stages": stages}
+
+class SamplingProfiler(object):
+    """
+    Samples the stacks of every thread in the process and writes them in the
+    collapsed format flamegraph.pl and speedscope read.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.thread = None
+
+    @property
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self, seconds=PROFILE_SECONDS):
+        if self.running:
+            return False
+
+        self.thread = threading.Thread(target=self._run, args=(seconds,), name="profiler", daemon=True)
+        self.thread.start()
+
+        return True
+
+    def _run(self, seconds):
+        stacks = collections.Counter()
+        own_ident = threading.get_ident()
+        names = {}
+        deadline = time.time() + seconds
+
+        while time.time() < deadline:
+            for thread in threading.enumerate():
+                names[thread.ident] = thread.name
+
+            for ident, frame in sys._current_frames().items():
+                if ident == own_ident:
+                    continue
+
+                stack = []
+                while frame:
+                    code = frame.f_code
+                    stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}")
+                    frame = frame.f_back
+
+                stack.append(names.get(ident, str(ident)))
+                stacks[";".join(reversed(stack))] += 1
+
+            time.sleep(self.interval)
+
+        filename = os.path.join(PROFILE_DIR, f"profile-{WORKER_NAME}-{os.getpid()}-{int(time.time())}.txt")
+        with open(filename, "w") as f:
+            for stack, count in stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+        print(f"Wrote {sum(stacks.values())} samples to {filename}.", flush=True)
+
+timers = StageTimers()
+timed = timers.time
+profiler = SamplingProfiler()
+
+def trigger_profile(value, source):
+    try:
+        seconds = float(value) or PROFILE_SECONDS
+    except ValueError:
+        seconds = PROFILE_SECONDS
+
+    if profiler.start(seconds):
+        print(f"Profiling for {seconds} seconds, triggered by {source}.", flush=True)
+
+def reporter(worker_type, redis):
+    last_report = time.time()
+    own_key = PROFILE_KEY % WORKER_NAME
+    all_key = PROFILE_KEY % "all"
+
+    # The shared key is never deleted, every change of its value profiles once.
+    try:
+        last_all = redis.get(all_key) if redis is not None else None
+    except RedisError:
+        last_all = None
+
+    while True:
+        time.sleep(5)
+
+        try:
+            if redis is not None:
+                value = redis.get(own_key)
+                if value is not None:
+                    redis.delete(own_key)
+                    trigger_profile(value, own_key)
+
+                value = redis.get(all_key)
+                if value is not None and value != last_all:
+                    last_all = value
+                    trigger_profile(value, all_key)
+
+            if time.time() - last_report >= STATS_INTERVAL:
+                last_report = time.time()
+                print(json.dumps(dict(
+                    stats=worker_type,
+                    worker=WORKER_NAME,
+                    pid=os.getpid(),
+                    **timers.summary()
+                )), flush=True)
+        except Exception:
+            if sentry_sdk:
+                sentry_sdk.capture_exception()
+            traceback.print_exc()
+
+def start(worker_type, redis=None):
+    """
+    Start periodic stage summaries and listen for profile triggers, either
+    SIGUSR1 or the tumblr:profile:<WORKER_NAME> / tumblr:profile:all keys.
+    """
+    try:
+        signal.signal(signal.SIGUSR1, lambda signum, frame: profiler.start())
+    except (ValueError, AttributeError):
+        # Not the main thread or no SIGUSR1 on this platform.
+        pass
+
+    thread = threading.Thread(target=reporter, args=(worker_type, redis), name="reporter", daemon=True)
+    thread.start()
+
+    return thread
@@ -0,0 +1,119 @@
+import os
+import json
+
+# The API caps /posts at 20 per page, ask for all of them explicitly.
+POSTS_PER_PAGE = 20
+
+# Pages per job on a full crawl. Incremental crawls are one job per blog.
+JOB_PAGES = int(os.environ.get("JOB_PAGES", 50))
+
+# offset pages by position, before by the timestamp of the last post seen.
+# auto uses before for blogs with more than PAGINATION_DEPTH posts, where deep offsets get slow.
+PAGINATION = os.environ.get("PAGINATION", "offset")
+PAGINATION_DEPTH = int(os.environ.get("PAGINATION_DEPTH", 10000))
+
+# compact or json. Fetchers read both, switch to json while old fetchers are still running.
+JOB_ENCODING = os.environ.get("JOB_ENCODING", "compact")
+
+DIGITS = "0123456789abcdefghijklmnopqrstuvwxyz"
+
+# Working members are "<claimed time>;<job>", heartbeats "<time>;<next offset or before>".
+
+def use_cursor(total_posts):
+    if PAGINATION == "auto":
+        return total_posts > PAGINATION_DEPTH
+
+    return PAGINATION == "before"
+
+def make_jobs(name, total_posts, last_crawl=None):
+    """
+    Split a blog into offset ranges. A range covers [offset, end). Incremental
+    crawls get a single range since fetchers stop at the first page older
+    than last_crawl anyway.
+
+    Cursor crawls are a single job per blog. Each page is chained from the
+    oldest post of the one before it, starting at the newest post (before 0).
+    """
+    last_crawl = str(last_crawl) if last_crawl else "0"
+    end = total_posts + POSTS_PER_PAGE
+
+    if use_cursor(total_posts):
+        return [dict(name=name, before=0, last_crawl=last_crawl)]
+
+    if last_crawl != "0":
+        step = end
+    else:
+        step = JOB_PAGES * POSTS_PER_PAGE
+
+    return [
+        dict(name=name, offset=offset, end=min(offset + step, end), last_crawl=last_crawl)
+        for offset in range(0, end, step)
+    ]
+
+def is_cursor_job(job):
+    return "before" in job
+
+def job_end(job):
+    # Jobs from before ranges existed cover a single page.
+    return int(job.get("end", int(job["offset"]) + POSTS_PER_PAGE))
+
+def resume_job(job, heartbeat):
+    # Restart a job from the last offset or cursor its fetcher reported.
+    if not heartbeat:
+        return job
+
+    _, position = heartbeat.split(";", 1)
+    if is_cursor_job(job):
+        return dict(job, before=int(position))
+
+    return dict(job, offset=int(position))
+
+def base36(number):
+    number = int(number)
+    if number < 0:
+        raise ValueError("Negative job field %r." % number)
+
+    digits = ""
+    while True:
+        number, digit = divmod(number, 36)
+        digits = DIGITS[digit] + digits
+        if not number:
+            return digits
+
+def encode_job(job, encoding=None):
+    """
+    Compact jobs are "o:<name>:<offset>:<end>:<last crawl>" for offset ranges
+    and "b:<name>:<before>:<last crawl>" for cursor jobs, numbers in base 36.
+    last_crawl is kept to the second.
+    """
+    if (encoding or JOB_ENCODING) == "json":
+        return json.dumps(job)
+
+    last_crawl = base36(float(job.get("last_crawl") or 0))
+
+    if is_cursor_job(job):
+        return "b:%s:%s:%s" % (job["name"], base36(job["before"]), last_crawl)
+
+    return "o:%s:%s:%s:%s" % (job["name"], base36(job["offset"]), base36(job_end(job)), last_crawl)
+
+def decode_job(raw):
+    if isinstance(raw, bytes):
+        raw = raw.decode("utf8")
+
+    if raw.startswith("{"):
+        return json.loads(raw)
+
+    fields = raw.split(":")
+    if fields[0] == "o" and len(fields) == 5:
+        return dict(name=fields[1], offset=int(fields[2], 36), end=int(fields[3], 36), last_crawl=str(int(fields[4], 36)))
+    if fields[0] == "b" and len(fields) == 4:
+        return dict(name=fields[1], before=int(fields[2], 36), last_crawl=str(int(fields[3], 36)))
+
+    raise ValueError("Unknown job %r." % raw)
+
+def last_seen(raw_work, heartbeat):
+    started, _ = raw_work.split(";", 1)
+    if heartbeat:
+        return max(float(started), float(heartbeat.split(";", 1)[0]))
+
+    return float(started)
@@ -0,0 +1,277 @@
+"""
+Redis key names and sharded sets.
+
+On a Redis Cluster, keys that are touched together (by a Lua script or an
+MGET) share a hash tag so they land in the same slot. On a single Redis the
+names are unchanged.
+"""
+import os
+import zlib
+import hashlib
+import collections
+
+from apipipeline.connections import REDIS_CLUSTER
+
+REDIS_SET_SHARDS = int(os.environ.get("REDIS_SET_SHARDS", 1))
+
+# Store lookup sets (tumblr:done, tumblr:warehoused) as HashedSets. Existing keys are moved with scripts/migrate_compact.py.
+REDIS_COMPACT_SETS = os.environ.get("REDIS_COMPACT_SETS", "") not in ("", "0")
+REDIS_HASHED_BUCKETS = int(os.environ.get("REDIS_HASHED_BUCKETS", 65536))
+
+# Members per HashedSet bucket to size for. Must stay below the server's hash-max-listpack-entries (128 by default).
+HASHED_BUCKET_MEMBERS = 100
+
+def tagged(group, suffix=""):
+    if REDIS_CLUSTER:
+        return "{%s}%s" % (group, suffix)
+
+    return group + suffix
+
+# Import jobs. FETCH_SCRIPT moves members between the queue and the working set.
+IMPORT_QUEUE = tagged("tumblr:queue:import")
+IMPORT_WORKING = tagged("tumblr:queue:import", ":working")
+IMPORT_HEARTBEAT = tagged("tumblr:queue:import", ":heartbeat")
+MANUAL_QUEUE = "tumblr:queue:manualqueue"
+
+# Parser input.
+POSTS_QUEUE = "tumblr:queue:posts"
+BLOGS_QUEUE = "tumblr:queue:blogs"
+
+BLOG_IDS = "tumblr:blogids"
+WORK_STATS = "tumblr:work_stats"
+
+# Blog discovery.
+URLS = "tumblr:urls"
+DONE = "tumblr:done"
+NOT_FOUND = "tumblr:404"
+BAD_INFO = "tumblr:badinfo"
+WAREHOUSED = "tumblr:warehoused"
+
+# Negative cache of dead, deleted and empty blogs, see apipipeline.negcache.
+DEAD_BLOGS = tagged("tumblr:dead")
+DEAD_BLOGS_INFO = tagged("tumblr:dead", ":info")
+
+# API key usage, read with one MGET.
+API_KEYS = "tumblr:keys"
+
+# Where load_info.py is in its scan of tumblr:urls.
+LOAD_INFO_CURSOR = "tumblr:load_info:cursor"
+
+# On-demand profile triggers, per WORKER_NAME or "all". A numeric value overrides the duration.
+PROFILE_KEY = "tumblr:profile:%s"
+
+# Response cache of the archives app, a sorted set of cache keys by last use.
+ARCHIVE_CACHE = "tumblr:archives:cache"
+
+def api_key(suffix):
+    return tagged(API_KEYS, ":" + suffix)
+
+def stored_layout(redis, key, configured, explicit=False):
+    """
+    The shard or bucket count a set was created with, kept at key so every
+    worker agrees on it. A set without one takes the configured count. An
+    explicit setting that disagrees is refused, members would be looked up
+    in the wrong keys.
+    """
+    stored = redis.get(key)
+    if stored is None:
+        redis.set(key, configured, nx=True)
+        stored = redis.get(key)
+
+    stored = int(stored)
+    if explicit and stored != configured:
+        raise ValueError("%s holds %d, but %d is configured. The existing members would be lost." % (key, stored, configured))
+
+    return stored
+
+class ShardedSet(object):
+    """
+    A set split over REDIS_SET_SHARDS keys by a hash of the member, so a
+    cluster spreads it over its nodes. With one shard it is the plain key.
+
+    The shard count is stored at <name>:shards on first use. Workers refuse
+    to run with a different REDIS_SHARDS_<NAME> or REDIS_SET_SHARDS, the
+    existing members would be in the wrong shards.
+    """
+
+    def __init__(self, redis, name, shards=None):
+        self.redis = redis
+        self.name = name
+
+        setting = os.environ.get("REDIS_SHARDS_" + name.split(":")[-1].upper(), os.environ.get("REDIS_SET_SHARDS"))
+        self.configured = shards or int(setting or REDIS_SET_SHARDS)
+        self.explicit = bool(shards or setting)
+        self._shards = None
+
+    @property
+    def meta_key(self):
+        return "%s:shards" % self.name
+
+    @property
+    def shards(self):
+        # Read on first use, importing a worker must not touch Redis.
+        if self._shards is None:
+            self._shards = stored_layout(self.redis, self.meta_key, self.configured, self.explicit)
+
+        return self._shards
+
+    def shard_key(self, shard):
+        if self.shards == 1:
+            return self.name
+
+        return "%s:%d" % (self.name, shard)
+
+    @property
+    def keys(self):
+        return [self.shard_key(shard) for shard in range(self.shards)]
+
+    def key_for(self, member):
+        if self.shards == 1:
+            return self.name
+
+        if isinstance(member, str):
+            member = member.encode("utf8")
+
+        return self.shard_key(zlib.crc32(member) % self.shards)
+
+    def group(self, members):
+        groups = collections.defaultdict(list)
+        for member in members:
+            groups[self.key_for(member)].append(member)
+
+        return groups
+
+    def add(self, *members, pipe=None):
+        if not members:
+            return
+
+        target = pipe or self.redis.pipeline(transaction=False)
+        for key, group in self.group(members).items():
+            target.sadd(key, *group)
+
+        if not pipe:
+            return sum(target.execute())
+
+    def contains(self, members):
+        pipe = self.redis.pipeline(transaction=False)
+        for member in members:
+            pipe.sismember(self.key_for(member), member)
+
+        return [bool(result) for result in pipe.execute()]
+
+    def __contains__(self, member):
+        return bool(self.redis.sismember(self.key_for(member), member))
+
+    def count(self):
+        pipe = self.redis.pipeline(transaction=False)
+        for key in self.keys:
+            pipe.scard(key)
+
+        return sum(pipe.execute())
+
+    def scan(self, cursor="0", count=500):
+        """
+        SSCAN over every shard in turn. Cursors are "<shard>:<cursor>" strings
+        and "0" once every shard is done.
+        """
+        shard, _, inner = str(cursor).partition(":")
+        if not inner:
+            shard, inner = "0", shard
+
+        shard, inner = int(shard), int(inner)
+        inner, members = self.redis.sscan(self.shard_key(shard), inner, count=count)
+
+        if int(inner) == 0:
+            shard += 1
+            if shard >= self.shards:
+                return "0", members
+
+        return "%d:%d" % (shard, int(inner)), members
+
+class HashedSet(object):
+    """
+    Membership-only set for the large lookup sets. Each member is kept as an
+    8 byte hash in one of many small hashes, which Redis stores as compact
+    listpacks while they stay under hash-max-listpack-entries (128 by
+    default). Members can't be listed back.
+
+    The bucket count is stored at <name>:h:buckets when the set is created,
+    scripts/migrate_compact.py sizes it for HASHED_BUCKET_MEMBERS per bucket.
+    New sets take REDIS_HASHED_BUCKETS_<NAME> or REDIS_HASHED_BUCKETS.
+    """
+
+    def __init__(self, redis, name, buckets=None):
+        self.redis = redis
+        self.name = name
+
+        setting = os.environ.get("REDIS_HASHED_BUCKETS_" + name.split(":")[-1].upper())
+        self.configured = buckets or int(setting or REDIS_HASHED_BUCKETS)
+        self.explicit = bool(buckets or setting)
+        self._buckets = None
+
+    @property
+    def meta_key(self):
+        return "%s:h:buckets" % self.name
+
+    @property
+    def buckets(self):
+        # Read on first use, importing a worker must not touch Redis.
+        if self._buckets is None:
+            self._buckets = stored_layout(self.redis, self.meta_key, self.configured, self.explicit)
+
+        return self._buckets
+
+    def bucket_key(self, bucket):
+        return "%s:h:%d" % (self.name, bucket)
+
+    @property
+    def keys(self):
+        return [self.bucket_key(bucket) for bucket in range(self.buckets)]
+
+    def locate(self, member):
+        if isinstance(member, str):
+            member = member.encode("utf8")
+
+        digest = hashlib.blake2b(member, digest_size=8).digest()
+        return self.bucket_key(int.from_bytes(digest[:4], "big") % self.buckets), digest
+
+    def add(self, *members, pipe=None):
+        if not members:
+            return
+
+        target = pipe or self.redis.pipeline(transaction=False)
+        for member in members:
+            key, field = self.locate(member)
+            target.hset(key, field, b"")
+
+        if not pipe:
+            return sum(target.execute())
+
+    def contains(self, members):
+        pipe = self.redis.pipeline(transaction=False)
+        for member in members:
+            pipe.hexists(*self.locate(member))
+
+        return [bool(result) for result in pipe.execute()]
+
+    def __contains__(self, member):
+        return bool(self.redis.hexists(*self.locate(member)))
+
+    def count(self, batch_size=1000):
+        keys = self.keys
+        total = 0
+
+        for index in range(0, len(keys), batch_size):
+            pipe = self.redis.pipeline(transaction=False)
+            for key in keys[index:index + batch_size]:
+                pipe.hlen(key)
+            total += sum(pipe.execute())
+
+        return total
+
+def lookup_set(redis, name):
+    # Sets that are only asked "is this in there", never listed.
+    if REDIS_COMPACT_SETS:
+        return HashedSet(redis, name)
+
+    return ShardedSet(redis, name)
@@ -0,0 +1,69 @@
+"""
+Tumblr media URL canonicalization.
+
+Tumblr serves every image in several sizes, all the same picture:
+
+    https://66.media.tumblr.com/<hash>/tumblr_<id>o1_1280.jpg        (and _500, _75sq, ...)
+    https://64.media.tumblr.com/<hash>/<hash>-<xx>/s640x960/<file>.png (and s1280x1920, ...)
+
+media_key() maps each of them to one key plus the width of that variant,
+collapse() keeps the widest variant per key.
+"""
+import re
+
+# tumblr_<id>[_r<revision>]_<width>[sq|h].<ext>, the media host and hash directory are optional.
+LEGACY_URL = re.compile(
+    r"^(?:https?:)?//[^/]*\.tumblr\.com/(?:[0-9a-f]+/)?(?P<name>tumblr_[A-Za-z0-9_]+?)_(?P<width>\d+)(?:sq|h)?\.\w+$"
+)
+
+# <hash>/<hash>-<xx>/s<width>x<height>[_c1]/<file>.<ext>, the file name differs per size.
+SIZED_URL = re.compile(
+    r"^(?:https?:)?//[^/]*\.tumblr\.com/(?P<name>[0-9a-f]+/[0-9a-f]+-[0-9a-z]+)/s(?P<width>\d+)x\d+(?:_c\d+)?/[^/]+$"
+)
+
+def media_key(url):
+    """
+    Returns (key, width) for a media URL. URLs that are not Tumblr media
+    are their own key with a width of 0.
+    """
+    for pattern in (LEGACY_URL, SIZED_URL):
+        match = pattern.match(url)
+        if match:
+            return match.group("name"), int(match.group("width"))
+
+    return url, 0
+
+def collapse(candidates, priority, variants=False):
+    """
+    Collapse (bucket, url) pairs into {bucket: set of urls} with one URL per
+    media key, the widest one. A key seen in several buckets is listed under
+    the first of them in priority. With variants, a "variants" bucket maps
+    each kept URL to the widths it was seen in.
+    """
+    groups = {}
+
+    for bucket, url in candidates:
+        if not url:
+            continue
+
+        key, width = media_key(url)
+        group = groups.get(key)
+        if group is None:
+            group = groups[key] = dict(url=url, width=width, bucket=bucket, widths=set())
+        elif width > group["width"]:
+            group["url"] = url
+            group["width"] = width
+
+        if priority.index(bucket) < priority.index(group["bucket"]):
+            group["bucket"] = bucket
+        group["widths"].add(width)
+
+    urls = {}
+    for group in groups.values():
+        urls.setdefault(group["bucket"], set()).add(group["url"])
+
+        if variants and len(group["widths"]) > 1:
+            widths = ",".join(str(width) for width in sorted(group["widths"], reverse=True))
+            urls.setdefault("variants", set()).add("%s %s" % (group["url"], widths))
+
+    return urls
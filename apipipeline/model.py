@@ -6,14 +6,11 @@ import datetime
 from urllib.parse import urlparse
 from contextlib import contextmanager
 
-# Compat before doing anything with SQL if on pypy.
-if platform.python_implementation() == "PyPy":
-    from psycopg2cffi import compat
-    compat.register()
-
 from apipipeline.connections import create_redis
+from apipipeline.instrumentation import timed
+from apipipeline.keys import BLOG_IDS
 
-from sqlalchemy import Column, Integer, String, Boolean, ForeignKey, BigInteger, DateTime, Unicode, create_engine, inspect
+from sqlalchemy import Column, Integer, String, Boolean, ForeignKey, BigInteger, DateTime, Unicode, create_engine, inspect, or_
 from sqlalchemy.dialects.postgresql import JSONB, ARRAY, insert
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import scoped_session, sessionmaker, relationship
@@ -23,17 +20,55 @@ from apipipeline.utils import clean_data
 
 debug = os.environ.get('DEBUG', False)
 
-if "POSTGRES_URL" not in os.environ or not os.environ["POSTGRES_URL"]:
-    print("POSTGRES_URL is missing. This is bad if you're running server processes.")
+# Connections are made on first use so importing the models stays cheap, see get_engine and get_db_redis.
+engine = None
+db_redis = None
+
+# Engines a forked child inherited. Kept referenced so garbage collection doesn't close the parent's sockets.
+inherited_engines = []
+
+def get_engine():
+    global engine
+
+    if engine is None:
+        # Compat before doing anything with SQL if on pypy.
+        if platform.python_implementation() == "PyPy":
+            from psycopg2cffi import compat
+            compat.register()
+
+        if "POSTGRES_URL" not in os.environ or not os.environ["POSTGRES_URL"]:
+            print("POSTGRES_URL is missing. This is bad if you're running server processes.")
+
+        engine = create_engine(os.environ.get("POSTGRES_URL", "postgres://placeholder/placeholder"), convert_unicode=True, pool_recycle=3600)
+
+        if debug:
+            engine.echo = True
 
-engine = create_engine(os.environ.get("POSTGRES_URL", "postgres://placeholder/placeholder"), convert_unicode=True, pool_recycle=3600)
+    return engine
 
-if debug:
-    engine.echo = True
+def get_db_redis():
+    global db_redis
 
-sm = sessionmaker(autocommit=False,
-                  autoflush=False,
-                  bind=engine)
+    if db_redis is None:
+        db_redis = create_redis()
+
+    return db_redis
+
+def reset_after_fork():
+    # Pooled connections can't be shared with the parent, the child opens its own when it needs one.
+    global engine, db_redis
+
+    if engine is not None:
+        inherited_engines.append(engine)
+    engine = None
+    db_redis = None
+
+os.register_at_fork(after_in_child=reset_after_fork)
+
+session_factory = sessionmaker(autocommit=False, autoflush=False)
+
+def sm():
+    return session_factory(bind=get_engine())
 
 base_session = scoped_session(sm)
 
@@ -53,7 +88,6 @@ def session_scope():
     finally:
         session.close()
 
-db_redis = create_redis()
 BLOG_ID_CACHE = {}
 
 
@@ -89,7 +123,7 @@ class Post(Base):
             if blog_name in BLOG_ID_CACHE:
                 author_id = BLOG_ID_CACHE[blog_name]
             else:
-                author_id = db_redis.hget("tumblr:blogids", blog_name)
+                author_id = get_db_redis().hget(BLOG_IDS, blog_name)
                 if author_id:
                     BLOG_ID_CACHE[blog_name] = author_id
 
@@ -106,14 +140,15 @@ class Post(Base):
                         author_id = new_author.id
 
                 if author_id:
-                    db_redis.hset("tumblr:blogids", blog_name, author_id)
+                    get_db_redis().hset(BLOG_IDS, blog_name, author_id)
                     BLOG_ID_CACHE[blog_name] = author_id
 
             if author_id:
                 post_data["author_id"] = author_id
 
         # Clean the data of null bytes.
-        clean_data(post_data)
+        with timed("clean"):
+            clean_data(post_data)
 
         # Create / Update the post object.
         if not post_object:
@@ -183,3 +218,22 @@ class Blog(Base):
 Index("index_blog_name", Blog.name)
 Index("post_tumblr_id_unique", Post.tumblr_id, Post.author_id, unique=True)
 Index("blog_uid_unique", Blog.tumblr_uid, unique=True)
+
+# Keyset pages of the archives app.
+Index("post_author_tumblr_id", Post.author_id, Post.tumblr_id)
+Index("post_posted_id", Post.posted, Post.id)
+
+# Lookups into the post JSON. The indexes below are built on these exact expressions and
+# apipipeline.queries filters on them, the planner only uses an expression index for the same expression.
+post_tags = Post.data["tags"]
+post_type = Post.data["type"].astext
+post_reblog_root = Post.data["reblogged_root_id"].astext
+post_note_count = Post.data["note_count"].astext.cast(Integer)
+blog_needs_crawl = or_(Blog.updated != Blog.last_crawl_update, Blog.last_crawl_update == None)
+
+# jsonb_path_ops is smaller and faster than the default GIN opclass but only serves @>.
+Index("post_tags_gin", post_tags.label("tags"), postgresql_using="gin", postgresql_ops={"tags": "jsonb_path_ops"})
+Index("post_type", post_type)
+Index("post_reblog_root", post_reblog_root)
+Index("post_note_count", post_note_count)
+Index("blog_needs_crawl", Blog.id, postgresql_where=blog_needs_crawl)
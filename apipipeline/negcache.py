@@ -0,0 +1,112 @@
+import os
+import time
+
+from apipipeline.jobs import decode_job
+from apipipeline.keys import DEAD_BLOGS, DEAD_BLOGS_INFO, IMPORT_QUEUE
+
+# Seconds until a dead blog is checked again, doubled every time it is still dead.
+DEAD_BLOG_TTL = int(os.environ.get("DEAD_BLOG_TTL", 7 * 86400))
+EMPTY_BLOG_TTL = int(os.environ.get("EMPTY_BLOG_TTL", 86400))
+DEAD_BLOG_MAX_TTL = int(os.environ.get("DEAD_BLOG_MAX_TTL", 90 * 86400))
+
+# 404s are deleted or renamed blogs. Empty blogs and bad info responses tend to change sooner.
+TTLS = {
+    "404": DEAD_BLOG_TTL,
+    "empty": EMPTY_BLOG_TTL,
+    "bad": EMPTY_BLOG_TTL,
+}
+
+def blog_name(url):
+    # tumblr:urls holds names, hostnames and urls.
+    name = url.strip().lower()
+    for prefix in ("https://", "http://"):
+        if name.startswith(prefix):
+            name = name[len(prefix):]
+
+    name = name.split("/", 1)[0]
+    if name.endswith(".tumblr.com"):
+        name = name[:-len(".tumblr.com")]
+
+    return name
+
+class NegativeCache(object):
+    """
+    Blogs that should not be fetched, with the time they are due for a
+    recheck. DEAD_BLOGS is a sorted set of names by recheck time and
+    DEAD_BLOGS_INFO a hash of "<reason>;<strikes>" per name.
+
+    A blog past its recheck time counts as alive again until it is marked
+    once more, so anything that hits it next acts as the recheck.
+    """
+
+    def __init__(self, redis):
+        self.redis = redis
+
+    def mark(self, name, reason, pipe=None):
+        name = blog_name(name)
+        info = self.redis.hget(DEAD_BLOGS_INFO, name)
+        strikes = int(info.split(";")[1]) + 1 if info else 1
+        ttl = min(TTLS.get(reason, DEAD_BLOG_TTL) * 2 ** (strikes - 1), DEAD_BLOG_MAX_TTL)
+
+        target = pipe or self.redis.pipeline(transaction=False)
+        target.zadd(DEAD_BLOGS, {name: time.time() + ttl})
+        target.hset(DEAD_BLOGS_INFO, name, "%s;%d" % (reason, strikes))
+
+        if not pipe:
+            target.execute()
+
+        return ttl
+
+    def clear(self, name, pipe=None):
+        name = blog_name(name)
+        target = pipe or self.redis.pipeline(transaction=False)
+        target.zrem(DEAD_BLOGS, name)
+        target.hdel(DEAD_BLOGS_INFO, name)
+
+        if not pipe:
+            target.execute()
+
+    def is_dead(self, name):
+        until = self.redis.zscore(DEAD_BLOGS, blog_name(name))
+        return until is not None and float(until) > time.time()
+
+    def dead(self, names):
+        pipe = self.redis.pipeline(transaction=False)
+        for name in names:
+            pipe.zscore(DEAD_BLOGS, blog_name(name))
+
+        now = time.time()
+        return [until is not None and float(until) > now for until in pipe.execute()]
+
+    def reason(self, name):
+        info = self.redis.hget(DEAD_BLOGS_INFO, blog_name(name))
+        return info.split(";")[0] if info else None
+
+    def due(self, limit=100):
+        # Dead blogs whose recheck time has passed, oldest first.
+        return self.redis.zrangebyscore(DEAD_BLOGS, 0, time.time(), start=0, num=limit)
+
+    def count(self):
+        return self.redis.zcard(DEAD_BLOGS)
+
+def purge_jobs(redis, name, batch_size=1000):
+    """
+    Drop every queued import job of a blog. The queue is only a few hundred
+    jobs deep, so a filtered SSCAN over it is cheap.
+    """
+    name = blog_name(name)
+    purged = 0
+
+    for pattern in ("o:%s:*" % name, "b:%s:*" % name, '{*"%s"*' % name):
+        members = []
+        for member in redis.sscan_iter(IMPORT_QUEUE, match=pattern, count=batch_size):
+            try:
+                if decode_job(member)["name"] == name:
+                    members.append(member)
+            except (TypeError, ValueError, KeyError):
+                continue
+
+        if members:
+            purged += redis.srem(IMPORT_QUEUE, *members)
+
+    return purged
@@ -0,0 +1,41 @@
+"""
+Post and blog lookups that filter on the indexed expressions from
+apipipeline.model. Build the indexes with scripts/build_indexes.py first.
+"""
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import ClauseElement, Executable
+
+from apipipeline.model import Post, Blog, post_tags, post_type, post_reblog_root, post_note_count, blog_needs_crawl
+
+def posts_with_tags(db, *tags):
+    # Posts tagged with all of tags. Only @> is served by the jsonb_path_ops index.
+    return db.query(Post).filter(post_tags.contains(list(tags)))
+
+def posts_of_type(db, kind):
+    return db.query(Post).filter(post_type == kind)
+
+def reblogs_of(db, root_id):
+    return db.query(Post).filter(post_reblog_root == str(root_id))
+
+def posts_with_notes(db, minimum, maximum=None):
+    query = db.query(Post).filter(post_note_count >= minimum)
+    if maximum is not None:
+        query = query.filter(post_note_count < maximum)
+
+    return query
+
+def blogs_needing_crawl(db):
+    # Blogs updated since their last crawl, from the blog_needs_crawl partial index.
+    return db.query(Blog).filter(blog_needs_crawl)
+
+class Explain(Executable, ClauseElement):
+    def __init__(self, statement):
+        self.statement = statement
+
+@compiles(Explain, "postgresql")
+def compile_explain(element, compiler, **kwargs):
+    return "EXPLAIN " + compiler.process(element.statement, **kwargs)
+
+def explain(db, query):
+    # The query plan as lines of text, binds go through the usual JSONB processing.
+    return [row[0] for row in db.execute(Explain(query.statement))]
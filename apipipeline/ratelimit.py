@@ -0,0 +1,42 @@
+import time
+import asyncio
+import threading
+
+from apipipeline.instrumentation import timed
+
+class RateLimiter(object):
+    """
+    Spaces out requests shared by every thread and task that holds it.
+    A rate of 0 disables limiting.
+    """
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0.0
+        self.lock = threading.Lock()
+        self.next_slot = 0.0
+
+    def reserve(self):
+        # Returns how long the caller has to wait for its slot.
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + self.interval
+
+        return slot - now
+
+    def pause(self, seconds):
+        # Push every pending and future request back, used when the API throttles us.
+        with self.lock:
+            self.next_slot = max(self.next_slot, time.monotonic() + seconds)
+
+    def wait(self):
+        delay = self.reserve()
+        if delay > 0:
+            with timed("ratelimit_sleep"):
+                time.sleep(delay)
+
+    async def wait_async(self):
+        delay = self.reserve()
+        if delay > 0:
+            with timed("ratelimit_sleep"):
+                await asyncio.sleep(delay)
@@ -3,22 +3,45 @@ import math
 import random
 import threading
 import time
-import json
+import traceback
 
 from sqlalchemy.sql.expression import func
-from sqlalchemy import or_
 
+from apipipeline import sentry_sdk, instrumentation
 from apipipeline.connections import create_redis, create_tumblr
+from apipipeline.instrumentation import timed
+from apipipeline.jobs import POSTS_PER_PAGE, make_jobs, encode_job, decode_job, resume_job, last_seen
+from apipipeline.keys import IMPORT_QUEUE, IMPORT_WORKING, IMPORT_HEARTBEAT, MANUAL_QUEUE, BLOGS_QUEUE
 from apipipeline.model import Blog, Post, sm
+from apipipeline.negcache import NegativeCache
+from apipipeline.queries import blogs_needing_crawl
+from apipipeline.utils import encode_payload
+
+# Jobs kept queued for the fetchers. A full crawl job is JOB_PAGES pages, an incremental one a few.
+IMPORT_QUEUE_JOBS = int(os.environ.get("IMPORT_QUEUE_JOBS", 32))
+
+# Dead blogs rechecked per round of the rechecker.
+RECHECK_BATCH = int(os.environ.get("RECHECK_BATCH", 50))
 
-redis = create_redis()
 running = True
 
 # Worker feeder
 
+def blog_info(tumblr, name):
+    with timed("api_wait"):
+        return tumblr.blog_info(name)
+
 def load_blog(db, redis, tumblr, blog, use_db=False):
+    negative = NegativeCache(redis)
+
+    # Known dead, the rechecker brings it back once it answers again.
+    if negative.is_dead(blog.name):
+        blog.last_crawl_update = blog.updated
+        db.commit()
+        return
+
     if not use_db:
-        info = tumblr.blog_info(blog.name)
+        info = blog_info(tumblr, blog.name)
     else:
         info = {
             "meta": {"status": 200},
@@ -27,13 +50,14 @@ def load_blog(db, redis, tumblr, blog, use_db=False):
 
         # In case bad data gets saved.
         if "posts" not in blog.data or not blog.data["posts"]:
-            info = tumblr.blog_info(blog.name)
+            info = blog_info(tumblr, blog.name)
 
     info_status_code = info.get("meta", {}).get("status", None) 
 
     # Handle errors
     if info_status_code == 404:
         print(info)
+        negative.mark(blog.name, "404")
         blog.last_crawl_update = blog.updated
         db.commit()
         return
@@ -43,42 +67,58 @@ def load_blog(db, redis, tumblr, blog, use_db=False):
         print(info)
         return
 
+    # Outages and revoked keys, try the blog again later. pytumblr strips meta from successful responses.
+    if info_status_code not in (None, 200):
+        print(info)
+        return
+
     if "blog" not in info or "posts" not in info["blog"]:
         print(info)
+        negative.mark(blog.name, "bad")
+        return
+
+    if not info["blog"]["posts"]:
+        negative.mark(blog.name, "empty")
+        blog.last_crawl_update = blog.updated
+        db.commit()
         return
 
     # Shoot the job off.
-    print("Adding %s offsets for %s" % (
-        math.ceil(info['blog']['posts'] / 20),
+    jobs = make_jobs(
+        blog.name,
+        info['blog']['posts'],
+        blog.last_crawl_update.timestamp() if blog.last_crawl_update else None
+    )
+
+    print("Adding %s jobs (%s offsets) for %s" % (
+        len(jobs),
+        math.ceil(info['blog']['posts'] / POSTS_PER_PAGE),
         blog.name
     ), flush=True)
 
-    for offset in range(0, info['blog']['posts'] + 20, 20):
-        redis.sadd("tumblr:queue:import", json.dumps({
-            "name": blog.name,
-            "offset": offset,
-            "last_crawl": str(blog.last_crawl_update.timestamp()) if blog.last_crawl_update else "0"
-        }))
+    with timed("enqueue"):
+        pipe = redis.pipeline(transaction=False)
+        pipe.sadd(IMPORT_QUEUE, *[encode_job(job) for job in jobs])
+        negative.clear(blog.name, pipe=pipe)
+        pipe.execute()
 
-    blog.last_crawl_update = blog.updated
-    db.commit()
+    with timed("commit"):
+        blog.last_crawl_update = blog.updated
+        db.commit()
 
-def get_blogs(db, manual_count):
+def get_blogs(db, redis, manual_count):
     use_db = False
     blogs = []
 
     if manual_count == 0:
-        blogs = db.query(Blog).filter(or_(
-            Blog.updated != Blog.last_crawl_update,
-            Blog.last_crawl_update == None
-        )).order_by(func.random()).limit(random.randint(1, 25)).all()
+        blogs = blogs_needing_crawl(db).order_by(func.random()).limit(random.randint(1, 25)).all()
         for blog in blogs:
             yield blog, use_db
     else:
         use_db = True
 
         while True:
-            blog_name = redis.spop("tumblr:queue:manualqueue")
+            blog_name = redis.spop(MANUAL_QUEUE)
             if not blog_name:
                 break
 
@@ -98,17 +138,17 @@ def worker_feeder():
     redis = create_redis()
 
     while running:
-        import_count = redis.scard("tumblr:queue:import")
-        working_count = redis.scard("tumblr:queue:import:working")
-        manual_count = redis.scard("tumblr:queue:manualqueue")
+        import_count = redis.scard(IMPORT_QUEUE)
+        working_count = redis.scard(IMPORT_WORKING)
+        manual_count = redis.scard(MANUAL_QUEUE)
 
-        print(f"{import_count} offsets queued. {working_count} being worked on.", flush=True)
+        print(f"{import_count} jobs queued. {working_count} being worked on.", flush=True)
 
-        if import_count > 420 and manual_count <= 0:  # Archiving secured.
+        if import_count > IMPORT_QUEUE_JOBS and manual_count <= 0:  # Archiving secured.
             time.sleep(1)
             continue
 
-        for blog, use_db in get_blogs(db, manual_count):
+        for blog, use_db in get_blogs(db, redis, manual_count):
             load_blog(db, redis, tumblr, blog, use_db)
 
 # Worker repusher
@@ -116,22 +156,104 @@ def worker_feeder():
 def worker_repusher():
     global running
     redis = create_redis()
+    negative = NegativeCache(redis)
 
     while running:
-        for raw_work in redis.smembers("tumblr:queue:import:working"):
+        heartbeats = redis.hgetall(IMPORT_HEARTBEAT)
+
+        for raw_work in redis.smembers(IMPORT_WORKING):
             started, work = raw_work.split(";", 1)
-            started_delta = (time.time() - float(started))
+            heartbeat = heartbeats.get(raw_work)
+            started_delta = (time.time() - last_seen(raw_work, heartbeat))
 
             if started_delta > 180:
-                print("Requing work that has been idle for %s seconds." % (started_delta))
-                redis.srem("tumblr:queue:import:working", raw_work)
-                redis.sadd("tumblr:queue:import", work)
+                pipe = redis.pipeline(transaction=False)
+                pipe.srem(IMPORT_WORKING, raw_work)
+                pipe.hdel(IMPORT_HEARTBEAT, raw_work)
+
+                try:
+                    job = decode_job(work)
+                except (TypeError, ValueError):
+                    job = None
+
+                if job is None:
+                    print("Dropping undecodable work %r." % work)
+                elif negative.is_dead(job.get("name", "")):
+                    print("Dropping work for dead blog %s." % job["name"])
+                else:
+                    # Resume from the last page the fetcher finished.
+                    try:
+                        work = encode_job(resume_job(job, heartbeat))
+                    except (TypeError, ValueError, KeyError):
+                        pass
+
+                    print("Requing work that has been idle for %s seconds." % (started_delta))
+                    pipe.sadd(IMPORT_QUEUE, work)
+
+                pipe.execute()
+
+        time.sleep(5)
+
+# Worker rechecker
+
+def recheck_blog(redis, tumblr, negative, name):
+    info = blog_info(tumblr, name)
+    status = info.get("meta", {}).get("status", None)
+
+    if status == 404:
+        ttl = negative.mark(name, "404")
+        print(f"{name} is still gone, next check in {ttl // 86400} days.", flush=True)
+    elif status not in (None, 200):
+        # Outages, throttling and revoked keys, try again next round.
+        return
+    elif "blog" not in info or "posts" not in info["blog"]:
+        negative.mark(name, "bad")
+    elif not info["blog"]["posts"]:
+        negative.mark(name, "empty")
+    else:
+        # Refresh the blog row and crawl it again, like load_info.py --db.
+        print(f"{name} is back with {info['blog']['posts']} posts.", flush=True)
+        pipe = redis.pipeline(transaction=False)
+        pipe.sadd(BLOGS_QUEUE, encode_payload(info))
+        pipe.sadd(MANUAL_QUEUE, info["blog"]["name"])
+        negative.clear(name, pipe=pipe)
+        pipe.execute()
+
+def worker_rechecker():
+    global running
+    redis = create_redis()
+    tumblr = create_tumblr()
+    negative = NegativeCache(redis)
+
+    while running:
+        try:
+            names = negative.due(RECHECK_BATCH)
+        except:
+            if sentry_sdk:
+                sentry_sdk.capture_exception()
+            traceback.print_exc()
+            names = []
+
+        for name in names:
+            if not running:
+                break
+
+            # One bad response or Redis hiccup must not take the loader down.
+            try:
+                with timed("recheck"):
+                    recheck_blog(redis, tumblr, negative, name)
+            except:
+                if sentry_sdk:
+                    sentry_sdk.capture_exception()
+                traceback.print_exc()
 
         time.sleep(5)
 
 if __name__ == "__main__":
+    instrumentation.start("queue_loader", create_redis())
     threads = [
-        threading.Thread(target=worker_repusher)
+        threading.Thread(target=worker_repusher),
+        threading.Thread(target=worker_rechecker),
     ]
 
     # Start multiple pushers
@@ -1,23 +1,28 @@
 import os
 import threading
 import time
-import json
 
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.dialects.postgresql import JSONB, ARRAY, insert
 
+from apipipeline import instrumentation
 from apipipeline.connections import create_redis
+from apipipeline.instrumentation import timed
+from apipipeline.keys import POSTS_QUEUE, BLOGS_QUEUE
 from apipipeline.model import Blog, Post, sm
+from apipipeline.utils import decode_payload
 
 running = True
 
 def get_item(db, model, raw_item):
     try:
-        item = json.loads(raw_item)
-    except (TypeError, json.decoder.JSONDecodeError):
+        with timed("decode"):
+            item = decode_payload(raw_item)
+    except (TypeError, ValueError):
         return
 
-    return model.create_from_metadata(db, item, insert_only=True)
+    with timed("map"):
+        return model.create_from_metadata(db, item, insert_only=True)
 
 def add_bulk(db, redis, model_type, key):
     if model_type == "blogs":
@@ -43,20 +48,21 @@ def add_bulk(db, redis, model_type, key):
             if bulks and len(bulks) % 500 == 0:
                 fast_commit = True
 
-                try:
-                    db.bulk_insert_mappings(
-                        model,
-                        bulks
-                    )
-                    db.commit()
-                except IntegrityError:
-                    fast_commit = False
-                    db.rollback()
-                    for data in bulks:
-                        db.execute(insert(model).values(
-                            **data
-                        ).on_conflict_do_nothing(index_elements=uniques))
-                    db.commit()
+                with timed("commit"):
+                    try:
+                        db.bulk_insert_mappings(
+                            model,
+                            bulks
+                        )
+                        db.commit()
+                    except IntegrityError:
+                        fast_commit = False
+                        db.rollback()
+                        for data in bulks:
+                            db.execute(insert(model).values(
+                                **data
+                            ).on_conflict_do_nothing(index_elements=uniques))
+                        db.commit()
 
                 # stats
                 delta_commit = time.time() - before_commit
@@ -65,20 +71,21 @@ def add_bulk(db, redis, model_type, key):
                 bulks.clear()
 
     fast_commit = True
-    try:
-        db.bulk_insert_mappings(
-            model,
-            bulks
-        )
+    with timed("commit"):
+        try:
+            db.bulk_insert_mappings(
+                model,
+                bulks
+            )
+            db.commit()
+        except IntegrityError:
+            fast_commit = False
+            db.rollback()
+            for data in bulks:
+                db.execute(insert(model).values(
+                    **data
+                ).on_conflict_do_nothing(index_elements=uniques))
         db.commit()
-    except IntegrityError:
-        fast_commit = False
-        db.rollback()
-        for data in bulks:
-            db.execute(insert(model).values(
-                **data
-            ).on_conflict_do_nothing(index_elements=uniques))
-    db.commit()
 
     # Final stats print
     delta_commit = time.time() - before_commit
@@ -88,11 +95,11 @@ def add_bulk(db, redis, model_type, key):
 def worker():
     global running
     db = sm()
-    redis = create_redis()
+    redis = create_redis(binary=True)
 
     while running:
-        post_count = redis.scard("tumblr:queue:posts")
-        blog_count = redis.scard("tumblr:queue:blogs")
+        post_count = redis.scard(POSTS_QUEUE)
+        blog_count = redis.scard(BLOGS_QUEUE)
     
         has_items = (post_count + blog_count) > 0
         if not has_items:
@@ -103,14 +110,15 @@ def worker():
 
         # Parse blogs
         if blog_count > 0:
-            add_bulk(db, redis, "blogs", "tumblr:queue:blogs")
+            add_bulk(db, redis, "blogs", BLOGS_QUEUE)
 
         # Parse posts
         if post_count > 0:
-            add_bulk(db, redis, "posts", "tumblr:queue:posts")
+            add_bulk(db, redis, "posts", POSTS_QUEUE)
 
 if __name__ == "__main__":
     threads = []
+    instrumentation.start("parser", create_redis())
 
     # Start multiple parsers
     for x in range(0, int(os.environ.get("WORKERS", 3))):
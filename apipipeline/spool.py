@@ -0,0 +1,141 @@
+import os
+import zlib
+import struct
+import threading
+
+SPOOL_DIR = os.environ.get("SPOOL_DIR", "spool")
+SEGMENT_BYTES = int(os.environ.get("SPOOL_SEGMENT_BYTES", 8 * 1024 * 1024))
+SPOOL_MAX_BYTES = int(os.environ.get("SPOOL_MAX_BYTES", 10 * 1024 * 1024 * 1024))
+
+# Payload length, key length, CRC32 of key and payload.
+HEADER = struct.Struct(">IHI")
+
+class Spool(object):
+    """
+    Append-only local log of queue payloads, split into segment files.
+    Writes are fsync'd before returning. Segments are replayed into Redis
+    oldest first and deleted once every record made it.
+
+    One spool directory belongs to one fetcher process.
+    """
+
+    def __init__(self, directory=SPOOL_DIR, segment_bytes=SEGMENT_BYTES, max_bytes=SPOOL_MAX_BYTES):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+
+        # Segments left over from a previous run are closed, start a new one after them.
+        existing = self.segment_numbers()
+        self.sequence = existing[-1] + 1 if existing else 0
+        self.closed_bytes = sum(os.path.getsize(self.segment_path(number)) for number in existing)
+        self.active = None
+        self.active_bytes = 0
+
+    def segment_path(self, number):
+        return os.path.join(self.directory, "segment-%012d.log" % number)
+
+    def segment_numbers(self):
+        if not os.path.isdir(self.directory):
+            return []
+
+        numbers = []
+        for filename in os.listdir(self.directory):
+            if filename.startswith("segment-") and filename.endswith(".log"):
+                numbers.append(int(filename[8:-4]))
+
+        return sorted(numbers)
+
+    @property
+    def size(self):
+        return self.closed_bytes + self.active_bytes
+
+    @property
+    def full(self):
+        return self.size >= self.max_bytes
+
+    def _rotate(self):
+        if self.active:
+            self.active.close()
+            self.active = None
+            self.closed_bytes += self.active_bytes
+            self.active_bytes = 0
+            self.sequence += 1
+
+    def write(self, key, payloads):
+        if isinstance(key, str):
+            key = key.encode("utf8")
+
+        records = []
+        for payload in payloads:
+            records.append(HEADER.pack(len(payload), len(key), zlib.crc32(key + payload)))
+            records.append(key)
+            records.append(payload)
+
+        data = b"".join(records)
+
+        with self.lock:
+            if not self.active:
+                os.makedirs(self.directory, exist_ok=True)
+                self.active = open(self.segment_path(self.sequence), "ab")
+
+            self.active.write(data)
+            self.active.flush()
+            os.fsync(self.active.fileno())
+            self.active_bytes += len(data)
+
+            if self.active_bytes >= self.segment_bytes:
+                self._rotate()
+
+    def read_segment(self, number):
+        with open(self.segment_path(number), "rb") as f:
+            while True:
+                header = f.read(HEADER.size)
+                if len(header) < HEADER.size:
+                    return
+
+                payload_length, key_length, checksum = HEADER.unpack(header)
+                key = f.read(key_length)
+                payload = f.read(payload_length)
+
+                # A torn write at the tail of a segment from a crash.
+                if len(payload) < payload_length or zlib.crc32(key + payload) != checksum:
+                    print(f"Spool segment {number} is truncated, dropping the rest of it.", flush=True)
+                    return
+
+                yield key.decode("utf8"), payload
+
+    def drain_segment(self, redis, batch_size=1000):
+        """
+        Replay the oldest segment into Redis. The active segment is closed
+        first if it is the only one left. Returns the records replayed or
+        None when the spool is empty.
+        """
+        with self.lock:
+            numbers = [number for number in self.segment_numbers() if number < self.sequence]
+            if not numbers and self.active_bytes:
+                self._rotate()
+                numbers = [number for number in self.segment_numbers() if number < self.sequence]
+
+        if not numbers:
+            return None
+
+        number = numbers[0]
+        path = self.segment_path(number)
+        replayed = 0
+        pipe = redis.pipeline(transaction=False)
+
+        # Replays after a crash only re-add members to sets, which is harmless.
+        for key, payload in self.read_segment(number):
+            pipe.sadd(key, payload)
+            replayed += 1
+            if replayed % batch_size == 0:
+                pipe.execute()
+
+        pipe.execute()
+
+        with self.lock:
+            self.closed_bytes -= os.path.getsize(path)
+            os.remove(path)
+
+        return replayed
@@ -1,6 +1,76 @@
+import os
+import json
+import zlib
+import threading
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Fields the archive never uses. Stripped from posts before they are queued.
+DEFAULT_DROP_FIELDS = "can_like,can_reblog,can_reply,can_send_in_message,display_avatar,followed,liked"
+DROP_FIELDS = frozenset(
+    field.strip()
+    for field in os.environ.get("POST_DROP_FIELDS", DEFAULT_DROP_FIELDS).split(",")
+    if field.strip()
+)
+
+# zstd frames start with this magic, zlib streams with 0x78 and JSON with "{".
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+QUEUE_COMPRESSION = os.environ.get("QUEUE_COMPRESSION", "zstd" if zstandard else "zlib")
+
+_local = threading.local()
+
 def clean_data(data):
     for key, value in data.items():
         if isinstance(value, dict):
             clean_data(value)
         elif isinstance(value, str):
             data[key] = value.replace('\x00', '')
+
+def project_fields(data, drop=DROP_FIELDS):
+    for field in drop:
+        data.pop(field, None)
+
+    return data
+
+def _zstd_compressor():
+    # zstd contexts are not thread safe, keep one per thread.
+    if not hasattr(_local, "compressor"):
+        _local.compressor = zstandard.ZstdCompressor(level=3)
+        _local.decompressor = zstandard.ZstdDecompressor()
+
+    return _local.compressor, _local.decompressor
+
+def encode_payload(data, compression=None):
+    raw = json.dumps(data, separators=(",", ":")).encode("utf8")
+    compression = compression or QUEUE_COMPRESSION
+
+    if compression == "zstd" and zstandard:
+        compressor, _ = _zstd_compressor()
+        return compressor.compress(raw)
+    elif compression in ("zstd", "zlib"):
+        return zlib.compress(raw, 6)
+
+    return raw
+
+def decode_payload(raw):
+    if isinstance(raw, str):
+        return json.loads(raw)
+
+    if raw.startswith(ZSTD_MAGIC):
+        if not zstandard:
+            raise ValueError("zstd payload found but zstandard is not installed.")
+        _, decompressor = _zstd_compressor()
+        try:
+            raw = decompressor.decompress(raw)
+        except zstandard.ZstdError as e:
+            raise ValueError(str(e))
+    elif raw[:1] == b"\x78":
+        try:
+            raw = zlib.decompress(raw)
+        except zlib.error as e:
+            raise ValueError(str(e))
+
+    return json.loads(raw)
@@ -0,0 +1,411 @@
+import os
+import re
+import json
+import copy
+import time
+import random
+import fnmatch
+import collections
+
+FIXTURES_DIR = os.path.join(os.path.dirname(__file__), "fixtures")
+MEDIA_HOST = "https://66.media.tumblr.com"
+ALT_WIDTHS = [1280, 640, 540, 500, 400, 250, 100, 75]
+WORDS = "lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor".split()
+
+# Synthetic data
+
+def _media_hash(rng):
+    return "%032x" % rng.getrandbits(128)
+
+def _photo(rng, width=1280, height=1920):
+    media_id = "tumblr_%s" % "".join(rng.choice("abcdefghijklmnopqrstuvwxyz0123456789") for _ in range(19))
+    folder = _media_hash(rng)
+    alt_sizes = []
+
+    for alt_width in ALT_WIDTHS:
+        if alt_width > width:
+            continue
+        alt_sizes.append({
+            "url": f"{MEDIA_HOST}/{folder}/{media_id}_{alt_width}.jpg",
+            "width": alt_width,
+            "height": int(height * alt_width / width),
+        })
+
+    return {
+        "caption": "",
+        "original_size": dict(alt_sizes[0]),
+        "alt_sizes": alt_sizes,
+    }
+
+def _html(rng, images=0):
+    paragraphs = ["<p>%s</p>" % " ".join(rng.choice(WORDS) for _ in range(rng.randint(5, 40))) for _ in range(rng.randint(1, 4))]
+
+    for _ in range(images):
+        photo = _photo(rng, 540, 810)
+        paragraphs.append('<figure class="tmblr-full"><img src="%s" data-orig-width="540"/></figure>' % photo["original_size"]["url"])
+
+    return "".join(paragraphs)
+
+def _blog(name):
+    return {
+        "name": name,
+        "title": name.title(),
+        "url": f"https://{name}.tumblr.com/",
+        "uuid": f"t:{name}",
+        "updated": 1540000000,
+    }
+
+def generate_post(rng, blog_name, post_id, timestamp, kind=None):
+    kind = kind or rng.choice(["photo", "photo", "text", "link"])
+
+    post = {
+        "type": kind,
+        "blog_name": blog_name,
+        "blog": _blog(blog_name),
+        "id": post_id,
+        "post_url": f"https://{blog_name}.tumblr.com/post/{post_id}",
+        "slug": "",
+        "date": time.strftime("%Y-%m-%d %H:%M:%S GMT", time.gmtime(timestamp)),
+        "timestamp": timestamp,
+        "state": "published",
+        "format": "html",
+        "reblog_key": "%08x" % rng.getrandbits(32),
+        "tags": [rng.choice(WORDS) for _ in range(rng.randint(0, 6))],
+        "short_url": f"https://tmblr.co/{post_id}",
+        "summary": " ".join(rng.choice(WORDS) for _ in range(8)),
+        "note_count": rng.randint(0, 5000),
+        "can_like": False,
+        "can_reblog": False,
+        "can_send_in_message": True,
+        "can_reply": False,
+        "display_avatar": True,
+        "reblog": {"comment": "", "tree_html": _html(rng)},
+        "trail": [],
+    }
+
+    if kind == "photo":
+        post["photos"] = [_photo(rng) for _ in range(rng.choice([1, 1, 1, 2, 4]))]
+        post["caption"] = _html(rng)
+    elif kind == "text":
+        post["title"] = " ".join(rng.choice(WORDS) for _ in range(4))
+        post["body"] = _html(rng, images=rng.randint(0, 3))
+    elif kind == "link":
+        post["url"] = "https://example.com/"
+        post["link_image"] = _photo(rng)["original_size"]["url"]
+        post["description"] = _html(rng)
+
+    # Reblog trails carry their own HTML and inline images.
+    for _ in range(rng.choice([0, 0, 1, 2])):
+        trail_blog = rng.choice(WORDS) + rng.choice(WORDS)
+        post["trail"].append({
+            "blog": {"name": trail_blog, "active": True},
+            "post": {"id": str(post_id - rng.randint(1, 10 ** 6))},
+            "content_raw": _html(rng, images=rng.randint(0, 2)),
+            "content": _html(rng, images=rng.randint(0, 2)),
+            "is_current_item": False,
+        })
+
+    return post
+
+def generate_blog_posts(blog_name, count, seed=0, start=1540000000):
+    rng = random.Random(f"{seed}:{blog_name}")
+    base_id = 170000000000 + rng.randint(0, 10 ** 9)
+
+    return [
+        generate_post(rng, blog_name, base_id - index * 97, start - index * 3600)
+        for index in range(count)
+    ]
+
+# Stand-ins
+
+class FakeTumblr(object):
+    """
+    Stand-in for pytumblr.TumblrRestClient. Serves recorded responses from
+    fixtures/*.json and synthesizes blogs that were not recorded.
+    """
+
+    def __init__(self, posts_per_blog=200, latency=0.0, seed=0, fixtures_dir=FIXTURES_DIR):
+        self.posts_per_blog = posts_per_blog
+        self.latency = latency
+        self.seed = seed
+        self.calls = collections.Counter()
+        self.blogs = {}
+
+        if fixtures_dir and os.path.isdir(fixtures_dir):
+            for filename in sorted(os.listdir(fixtures_dir)):
+                if filename.endswith(".json"):
+                    with open(os.path.join(fixtures_dir, filename)) as f:
+                        self.blogs.update(json.load(f)["blogs"])
+
+    def _get_blog(self, name):
+        name = name.replace(".tumblr.com", "")
+
+        if name not in self.blogs:
+            posts = generate_blog_posts(name, self.posts_per_blog, self.seed)
+            self.blogs[name] = {
+                "info": dict(_blog(name), posts=len(posts)),
+                "posts": posts,
+            }
+
+        return self.blogs[name]
+
+    def _respond(self, data):
+        if self.latency:
+            time.sleep(self.latency)
+
+        # Round trip through JSON so callers get fresh objects like the real client.
+        return json.loads(json.dumps(data))
+
+    def blog_info(self, blogname):
+        self.calls["blog_info"] += 1
+        blog = self._get_blog(blogname)
+
+        return self._respond({"blog": blog["info"]})
+
+    def posts(self, blogname, type=None, **kwargs):
+        self.calls["posts"] += 1
+        blog = self._get_blog(blogname)
+        limit = int(kwargs.get("limit", 20))
+        posts = blog["posts"]
+
+        if "before" in kwargs:
+            posts = [post for post in posts if post["timestamp"] < int(kwargs["before"])]
+        else:
+            offset = int(kwargs.get("offset", 0))
+            posts = posts[offset:]
+
+        return self._respond({
+            "blog": blog["info"],
+            "posts": posts[:limit],
+            "total_posts": len(blog["posts"]),
+        })
+
+class FakePipeline(object):
+    def __init__(self, redis):
+        self.redis = redis
+        self.calls = []
+
+    def __getattr__(self, name):
+        method = getattr(self.redis, name)
+
+        def queue(*args, **kwargs):
+            self.calls.append((method, args, kwargs))
+            return self
+
+        return queue
+
+    def execute(self):
+        results = [method(*args, **kwargs) for method, args, kwargs in self.calls]
+        self.calls = []
+        return results
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.calls = []
+
+class FakeRedis(object):
+    """
+    In-memory stand-in for the subset of StrictRedis the pipeline uses.
+    Members come back exactly as they were stored.
+    """
+
+    def __init__(self):
+        self.data = {}
+
+    def _get(self, key, factory):
+        if key not in self.data:
+            self.data[key] = factory()
+        return self.data[key]
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    def register_script(self, script):
+        # FETCH_SCRIPT is the only script the pipeline registers.
+        def fetch(keys, args=None):
+            item = self.spop(keys[0])
+            if item is None:
+                return None
+
+            now = str(int(time.time()))
+            self.sadd(keys[1], now + ";" + item)
+            return [now, item]
+
+        return fetch
+
+    def delete(self, *keys):
+        return sum(1 for key in keys if self.data.pop(key, None) is not None)
+
+    def exists(self, *keys):
+        return sum(1 for key in keys if key in self.data)
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def mget(self, keys):
+        return [self.data.get(key) for key in keys]
+
+    def set(self, key, value, ex=None, nx=False):
+        if nx and key in self.data:
+            return None
+        self.data[key] = value
+        return True
+
+    def incr(self, key, amount=1):
+        self.data[key] = int(self.data.get(key, 0)) + amount
+        return self.data[key]
+
+    def expire(self, key, seconds):
+        return key in self.data
+
+    # Sets
+
+    def sadd(self, key, *members):
+        items = self._get(key, set)
+        before = len(items)
+        items.update(members)
+        return len(items) - before
+
+    def srem(self, key, *members):
+        items = self._get(key, set)
+        before = len(items)
+        items.difference_update(members)
+        return before - len(items)
+
+    def scard(self, key):
+        return len(self.data.get(key, ()))
+
+    def sismember(self, key, member):
+        return member in self.data.get(key, ())
+
+    def smismember(self, key, members):
+        items = self.data.get(key, ())
+        return [member in items for member in members]
+
+    def smembers(self, key):
+        return set(self.data.get(key, ()))
+
+    def spop(self, key, count=None):
+        items = self.data.get(key, set())
+
+        if count is None:
+            return items.pop() if items else None
+
+        return [items.pop() for _ in range(min(count, len(items)))]
+
+    def sscan(self, key, cursor=0, match=None, count=None):
+        items = sorted(self.data.get(key, ()))
+        count = count or 10
+        batch = items[cursor:cursor + count]
+        next_cursor = cursor + count if cursor + count < len(items) else 0
+        return next_cursor, batch
+
+    def sscan_iter(self, key, match=None, count=None):
+        pattern = re.compile(fnmatch.translate(match)) if match else None
+        for member in sorted(self.data.get(key, ())):
+            if pattern is None or pattern.match(member):
+                yield member
+
+    # Hashes
+
+    def hget(self, key, field):
+        return self.data.get(key, {}).get(field)
+
+    def hset(self, key, field, value):
+        items = self._get(key, dict)
+        created = field not in items
+        items[field] = value
+        return int(created)
+
+    def hdel(self, key, *fields):
+        items = self._get(key, dict)
+        return sum(1 for field in fields if items.pop(field, None) is not None)
+
+    def hexists(self, key, field):
+        return field in self.data.get(key, {})
+
+    def hlen(self, key):
+        return len(self.data.get(key, {}))
+
+    def hgetall(self, key):
+        return dict(self.data.get(key, {}))
+
+    def hincrby(self, key, field, amount=1):
+        items = self._get(key, dict)
+        items[field] = int(items.get(field, 0)) + amount
+        return items[field]
+
+    # Sorted sets
+
+    def zadd(self, key, mapping, nx=False, xx=False):
+        items = self._get(key, dict)
+        added = 0
+        for member, score in mapping.items():
+            if (nx and member in items) or (xx and member not in items):
+                continue
+            added += member not in items
+            items[member] = float(score)
+        return added
+
+    def zrem(self, key, *members):
+        items = self._get(key, dict)
+        return sum(1 for member in members if items.pop(member, None) is not None)
+
+    def zscore(self, key, member):
+        return self.data.get(key, {}).get(member)
+
+    def zcard(self, key):
+        return len(self.data.get(key, ()))
+
+    def zpopmin(self, key, count=1):
+        items = self._get(key, dict)
+        popped = sorted(items.items(), key=lambda item: item[1])[:count]
+        for member, _ in popped:
+            del items[member]
+        return popped
+
+    def zrangebyscore(self, key, min, max, start=None, num=None, withscores=False):
+        low, high = float(min), float(max)
+        items = sorted((item for item in self.data.get(key, {}).items() if low <= item[1] <= high), key=lambda item: item[1])
+        if start is not None:
+            items = items[start:start + num]
+        return items if withscores else [member for member, _ in items]
+
+class FakeSession(object):
+    """
+    Stand-in for a SQLAlchemy session that only counts what add_bulk writes.
+    """
+
+    def __init__(self):
+        self.inserted = 0
+        self.commits = 0
+
+    def bulk_insert_mappings(self, model, mappings):
+        self.inserted += len(mappings)
+
+    def execute(self, *args, **kwargs):
+        self.inserted += 1
+
+    def flush(self):
+        pass
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+def create_bench_redis():
+    if "BENCH_REDIS_URL" in os.environ:
+        from redis import StrictRedis
+        return StrictRedis.from_url(os.environ["BENCH_REDIS_URL"])
+
+    return FakeRedis()
+
+def clone(data):
+    return copy.deepcopy(data)
@@ -0,0 +1,88 @@
+"""
+Import time and import side effect check for worker entry points.
+
+    python -m benchmarks.importtime
+    python -m benchmarks.importtime --budget 400 apipipeline.server_parser
+
+Every module is imported in a fresh interpreter. Fails when an import is
+slower than the budget or opens a network connection.
+"""
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MODULES = [
+    "apipipeline.model",
+    "apipipeline.server_parser",
+    "apipipeline.server_load_queue",
+    "apipipeline.client_fetch_posts",
+    "create_urlist",
+]
+
+# Records every connect() made while importing, then prints them as JSON.
+PROBE = """
+import sys, json, socket
+connects = []
+original_connect = socket.socket.connect
+def connect(self, address):
+    connects.append(repr(address))
+    return original_connect(self, address)
+socket.socket.connect = connect
+import %s
+print(json.dumps(connects))
+"""
+
+def run(module):
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join([ROOT, os.path.join(ROOT, "scripts"), env.get("PYTHONPATH", "")])
+
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", PROBE % module],
+        env=env,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    )
+
+    # Lines look like "import time: self [us] | cumulative | imported package".
+    total = 0
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+
+        _, cumulative, name = line.split("|")
+        if name.strip() == module:
+            total = int(cumulative)
+
+    return total / 1000.0, json.loads(result.stdout.strip().splitlines()[-1])
+
+def main():
+    parser = argparse.ArgumentParser(description="Check worker import times.")
+    parser.add_argument("modules", nargs="*", help="Modules to import. Defaults to the worker entry points.")
+    parser.add_argument("--budget", type=float, default=float(os.environ.get("IMPORT_BUDGET_MS", 500)), help="Milliseconds per import.")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per module, the fastest one is kept.")
+    args = parser.parse_args()
+
+    failed = []
+    for module in args.modules or MODULES:
+        runs = [run(module) for _ in range(args.repeat)]
+        milliseconds = min(milliseconds for milliseconds, _ in runs)
+        connects = runs[0][1]
+
+        print(f"{module}: {milliseconds:.1f} ms, {len(connects)} connections", flush=True)
+        if milliseconds > args.budget:
+            failed.append(f"{module} took {milliseconds:.1f} ms, budget is {args.budget:.0f} ms")
+        if connects:
+            failed.append(f"{module} connected to {', '.join(connects)} on import")
+
+    if failed:
+        print("\n".join(failed), file=sys.stderr)
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,309 @@
+"""
+Replays traffic captured with CAPTURE_RATE (see apipipeline.capture) for
+capacity testing.
+
+    python -m benchmarks.replay parser capture/ --speed 1
+    python -m benchmarks.replay parser capture/ --speed 3 --workers 3 --postgres
+    python -m benchmarks.replay fetcher capture/ --speed max
+
+parser pushes captured queue payloads into Redis at the captured pace times
+--speed while server_parser.add_bulk workers drain them. fetcher runs the
+captured API responses through BlogManager.process with a stand-in client.
+Throttled and error pages, which the fetcher would sleep on and ask for
+again, are counted as error_pages instead.
+
+Runs against the stand-ins in benchmarks.fakes unless BENCH_REDIS_URL (a
+scratch Redis, its queues are emptied) or --postgres (uses POSTGRES_URL) is
+given. Captures are sampled, so the production rate is estimated as the
+captured rate divided by the sample rate.
+"""
+import os
+import json
+import time
+import heapq
+import argparse
+import threading
+import collections
+
+from benchmarks.fakes import FakeTumblr, FakeSession, create_bench_redis
+
+from apipipeline import model
+from apipipeline import server_parser
+from apipipeline.capture import read_capture, capture_files
+from apipipeline.instrumentation import timers, percentile
+from apipipeline.keys import POSTS_QUEUE, BLOGS_QUEUE, BLOG_IDS
+from apipipeline.utils import decode_payload
+
+QUEUE_MODELS = {POSTS_QUEUE: "posts", BLOGS_QUEUE: "blogs"}
+
+def load_records(paths, kinds):
+    """
+    Records of the given kinds from every file, merged into capture time
+    order, and the sample rate they were captured at.
+    """
+    rates = []
+
+    def records(path):
+        for seen, kind, payload in read_capture([path]):
+            if kind == "meta":
+                rates.append(json.loads(payload)["rate"])
+            elif kind in kinds:
+                yield seen, kind, payload
+
+    merged = list(heapq.merge(*[records(path) for path in paths], key=lambda record: record[0]))
+    rate = sum(rates) / len(rates) if rates else 1.0
+
+    return merged, rate
+
+def pace(records, speed):
+    # Yields records once their captured offset, divided by speed, has passed.
+    if not records:
+        return
+
+    first = records[0][0]
+    started = time.perf_counter()
+
+    for record in records:
+        if speed:
+            delay = (record[0] - first) / speed - (time.perf_counter() - started)
+            if delay > 0:
+                time.sleep(delay)
+
+        yield record
+
+def latency_summary(values):
+    values = sorted(values)
+    if not values:
+        return None
+
+    return {
+        "count": len(values),
+        "p50": round(percentile(values, 50), 6),
+        "p95": round(percentile(values, 95), 6),
+        "p99": round(percentile(values, 99), 6),
+        "max": round(values[-1], 6),
+    }
+
+def captured_rate(records, sample_rate):
+    if len(records) < 2:
+        return None
+
+    span = records[-1][0] - records[0][0]
+    return round(len(records) / span / sample_rate, 2) if span else None
+
+class TimedQueue(object):
+    """
+    Wraps the Redis client handed to add_bulk to measure how long each
+    payload waited in the queue.
+    """
+
+    def __init__(self, redis):
+        self.redis = redis
+        self.pushed = {}
+        self.waits = []
+        self.popped = 0
+        self.lock = threading.Lock()
+
+    def push(self, key, payloads):
+        now = time.perf_counter()
+        with self.lock:
+            for payload in payloads:
+                self.pushed[payload] = now
+        self.redis.sadd(key, *payloads)
+
+    def spop(self, key, count=None):
+        items = self.redis.spop(key, count=count)
+        now = time.perf_counter()
+
+        with self.lock:
+            for item in items or ():
+                started = self.pushed.pop(item, None)
+                if started is not None:
+                    self.waits.append(now - started)
+            self.popped += len(items or ())
+
+        return items
+
+    def __getattr__(self, name):
+        return getattr(self.redis, name)
+
+def prepare_fake_authors(redis, records):
+    # Without Postgres authors can't be looked up, give every captured blog an id up front.
+    names = set()
+    for _, kind, payload in records:
+        if kind == POSTS_QUEUE:
+            try:
+                names.add(decode_payload(payload).get("blog_name", ""))
+            except (TypeError, ValueError):
+                continue
+
+    for index, name in enumerate(sorted(names)):
+        redis.hset(BLOG_IDS, name, index + 1)
+
+def replay_parser(args):
+    records, sample_rate = load_records(args.paths, QUEUE_MODELS)
+    redis = create_bench_redis()
+    redis.delete(POSTS_QUEUE, BLOGS_QUEUE)
+    model.db_redis = redis
+    model.BLOG_ID_CACHE.clear()
+
+    if not args.postgres:
+        prepare_fake_authors(redis, records)
+
+    queue = TimedQueue(redis)
+    feeding = threading.Event()
+    feeding.set()
+    depths = []
+
+    def parse():
+        db = model.sm() if args.postgres else FakeSession()
+        while feeding.is_set() or redis.scard(POSTS_QUEUE) + redis.scard(BLOGS_QUEUE):
+            for key, model_type in QUEUE_MODELS.items():
+                if redis.scard(key):
+                    server_parser.add_bulk(db, queue, model_type, key)
+            time.sleep(0.05)
+        db.close()
+
+    workers = [threading.Thread(target=parse, name=f"parser{index}") for index in range(args.workers)]
+    timers.reset()
+    started = time.perf_counter()
+    for worker in workers:
+        worker.start()
+
+    # Payloads captured in the same 10ms go in as one push, like a fetched page.
+    batch = collections.defaultdict(list)
+    batch_started = None
+    for seen, kind, payload in pace(records, args.speed):
+        if batch_started is not None and seen - batch_started > 0.01:
+            for key, payloads in batch.items():
+                queue.push(key, payloads)
+            batch.clear()
+            depths.append(redis.scard(POSTS_QUEUE) + redis.scard(BLOGS_QUEUE))
+            batch_started = None
+
+        batch[kind].append(payload)
+        batch_started = seen if batch_started is None else batch_started
+
+    for key, payloads in batch.items():
+        queue.push(key, payloads)
+
+    fed = time.perf_counter()
+    feeding.clear()
+    for worker in workers:
+        worker.join()
+    seconds = time.perf_counter() - started
+
+    return {
+        "records": len(records),
+        "sample_rate": sample_rate,
+        "production_per_sec": captured_rate(records, sample_rate),
+        "offered_per_sec": round(len(records) / (fed - started), 2) if fed > started else None,
+        "processed": queue.popped,
+        "per_sec": round(queue.popped / seconds, 2),
+        "drain_seconds": round(time.perf_counter() - fed, 3),
+        "max_queue_depth": max(depths) if depths else 0,
+        "queue_wait": latency_summary(queue.waits),
+        "stages": timers.summary()["stages"],
+    }
+
+def retried(response):
+    # BlogManager.process sleeps and asks again for these, the capture has no second answer.
+    status = response.get("meta", {}).get("status")
+    return status != 404 and (status in (502, 503, 429) or "posts" not in response)
+
+class ReplayTumblr(FakeTumblr):
+    """
+    Answers posts calls with the captured responses, in capture order.
+    """
+
+    def __init__(self):
+        super().__init__(fixtures_dir=None)
+        self.responses = collections.deque()
+
+    def posts(self, blogname, type=None, **kwargs):
+        self.calls["posts"] += 1
+        return self.responses.popleft()
+
+def replay_fetcher(args):
+    from apipipeline.client_fetch_posts import BlogManager, DeadBlog
+    from apipipeline.negcache import NegativeCache
+    from apipipeline.ratelimit import RateLimiter
+
+    records, sample_rate = load_records(args.paths, {"api:posts"})
+    redis = create_bench_redis()
+    redis.delete(POSTS_QUEUE)
+
+    manager = BlogManager()
+    manager.tumblr = ReplayTumblr()
+    manager.redis = redis
+    manager.negative = NegativeCache(redis)
+    manager.limiter = RateLimiter(0)
+    manager.log = lambda *args: None
+
+    latencies = []
+    posts = 0
+    error_pages = 0
+    started = time.perf_counter()
+
+    for _, _, payload in pace(records, args.speed):
+        request = json.loads(payload)
+        if retried(request["response"]):
+            error_pages += 1
+            continue
+
+        manager.tumblr.responses.append(request["response"])
+
+        call_started = time.perf_counter()
+        try:
+            _, page = manager.process(request["name"], request["offset"], 0.0, request["before"])
+            posts += len(page)
+        except DeadBlog:
+            pass
+        latencies.append(time.perf_counter() - call_started)
+
+    seconds = time.perf_counter() - started
+
+    return {
+        "records": len(records),
+        "sample_rate": sample_rate,
+        "production_per_sec": captured_rate(records, sample_rate),
+        "pages": len(latencies),
+        "error_pages": error_pages,
+        "posts": posts,
+        "per_sec": round(len(latencies) / seconds, 2) if seconds else None,
+        "posts_per_sec": round(posts / seconds, 2) if seconds else None,
+        "page_latency": latency_summary(latencies),
+        "stages": timers.summary()["stages"],
+    }
+
+def speed(value):
+    return 0.0 if value == "max" else float(value)
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay captured traffic.")
+    parser.add_argument("target", choices=["parser", "fetcher"])
+    parser.add_argument("paths", nargs="+", help="Capture files or directories.")
+    parser.add_argument("--speed", type=speed, default=1.0, help="Multiple of the captured pace, or max.")
+    parser.add_argument("--workers", type=int, default=3, help="Parser threads.")
+    parser.add_argument("--postgres", action="store_true", help="Write to POSTGRES_URL instead of a fake session.")
+    parser.add_argument("--output", help="Write results as JSON to this path.")
+    args = parser.parse_args()
+
+    paths = []
+    for path in args.paths:
+        paths.extend(capture_files(path) if os.path.isdir(path) else [path])
+    args.paths = paths
+
+    if args.target == "parser":
+        result = replay_parser(args)
+    else:
+        result = replay_fetcher(args)
+
+    output = json.dumps(dict(target=args.target, speed=args.speed or "max", **result), indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    print(output)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,259 @@
+"""
+Offline throughput benchmarks for the pipeline.
+
+    python -m benchmarks.run --output bench.json
+    python -m benchmarks.run --compare bench.json
+
+Everything runs against the stand-ins in benchmarks.fakes unless
+BENCH_REDIS_URL (a scratch Redis) or --postgres (uses POSTGRES_URL) is given.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import subprocess
+
+from benchmarks.fakes import FakeTumblr, FakeSession, create_bench_redis, generate_blog_posts, clone
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "scripts"))
+
+from apipipeline import model
+from apipipeline.model import Post
+from apipipeline.utils import clean_data
+from apipipeline.keys import POSTS_QUEUE, BLOG_IDS
+from apipipeline.client_fetch_posts import BlogManager, POSTS_PER_PAGE
+from apipipeline.negcache import NegativeCache
+from apipipeline.ratelimit import RateLimiter
+from apipipeline import server_parser
+
+BENCHMARKS = {}
+
+def benchmark(func):
+    BENCHMARKS[func.__name__.replace("bench_", "")] = func
+    return func
+
+def sample_posts(count, blogs=10):
+    posts = []
+    for index in range(blogs):
+        posts.extend(generate_blog_posts(f"benchblog{index}", count // blogs))
+    return posts
+
+def setup_model(redis):
+    # Post.create_from_metadata resolves authors through db_redis.
+    model.db_redis = redis
+    model.BLOG_ID_CACHE.clear()
+
+def create_db(args):
+    if args.postgres:
+        return model.sm()
+    return FakeSession()
+
+def measure(func, ops):
+    started = time.perf_counter()
+    func()
+    seconds = time.perf_counter() - started
+
+    return {
+        "ops": ops,
+        "seconds": round(seconds, 6),
+        "per_sec": round(ops / seconds, 2) if seconds else None,
+    }
+
+@benchmark
+def bench_end_to_end(args):
+    redis = create_bench_redis()
+    redis.delete(POSTS_QUEUE)
+    setup_model(redis)
+
+    manager = BlogManager()
+    manager.tumblr = FakeTumblr(posts_per_blog=args.posts // args.blogs)
+    manager.redis = redis
+    manager.negative = NegativeCache(redis)
+    manager.limiter = RateLimiter(0)
+    manager.log = lambda *args: None
+
+    blog_names = [f"benchblog{index}" for index in range(args.blogs)]
+    for index, name in enumerate(blog_names):
+        redis.hset(BLOG_IDS, name, index + 1)
+
+    def fetch():
+        for name in blog_names:
+            for offset in range(0, args.posts // args.blogs, POSTS_PER_PAGE):
+                manager.process(name, offset, 0.0)
+
+    db = create_db(args)
+
+    def parse():
+        server_parser.add_bulk(db, redis, "posts", POSTS_QUEUE)
+
+    fetched = measure(fetch, args.posts)
+    parsed = measure(parse, args.posts)
+    seconds = fetched["seconds"] + parsed["seconds"]
+
+    return {
+        "ops": args.posts,
+        "seconds": round(seconds, 6),
+        "per_sec": round(args.posts / seconds, 2),
+        "fetch_per_sec": fetched["per_sec"],
+        "parse_per_sec": parsed["per_sec"],
+    }
+
+@benchmark
+def bench_extract_photos(args):
+    from create_urlist import extract_photos
+
+    posts = sample_posts(args.posts, args.blogs)
+
+    def run():
+        for post in posts:
+            extract_photos(post)
+
+    return measure(run, len(posts))
+
+@benchmark
+def bench_clean_data(args):
+    posts = [clone(post) for post in sample_posts(args.posts, args.blogs)]
+
+    def run():
+        for post in posts:
+            clean_data(post)
+
+    return measure(run, len(posts))
+
+@benchmark
+def bench_create_from_metadata(args):
+    redis = create_bench_redis()
+    setup_model(redis)
+    posts = sample_posts(args.posts, args.blogs)
+    for index in range(args.blogs):
+        redis.hset(BLOG_IDS, f"benchblog{index}", index + 1)
+
+    db = create_db(args)
+
+    def run():
+        for post in posts:
+            Post.create_from_metadata(db, post, insert_only=True)
+
+    return measure(run, len(posts))
+
+@benchmark
+def bench_download(args):
+    import asyncio
+    import tempfile
+    from aiohttp import web
+    from apipipeline.downloader import Downloader
+
+    # Local stand-in for the media hosts, every tenth url is gone.
+    body = os.urandom(64 * 1024)
+
+    async def serve(request):
+        index = int(request.match_info["index"])
+        if index % 10 == 0:
+            raise web.HTTPNotFound()
+        return web.Response(body=body[:-1 - index % 1000] + str(index).encode())
+
+    async def run(directory):
+        app = web.Application()
+        app.router.add_get("/media/{index}.jpg", serve)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+
+        urls = [f"http://127.0.0.1:{port}/media/{index}.jpg" for index in range(args.posts)]
+        try:
+            first_run, second_run = Downloader(directory), Downloader(directory)
+            first = await first_run.run(urls)
+            first_run.close()
+            # A resumed run only checks the index.
+            second = await second_run.run(urls)
+            second_run.close()
+        finally:
+            await runner.cleanup()
+
+        return first, second
+
+    with tempfile.TemporaryDirectory() as directory:
+        started = time.perf_counter()
+        first, second = asyncio.run(run(directory))
+        seconds = time.perf_counter() - started
+
+    return {
+        "ops": args.posts,
+        "seconds": round(seconds, 6),
+        "per_sec": first["files_per_sec"],
+        "mbytes_per_sec": first["mbytes_per_sec"],
+        "missing": first["missing"],
+        "failed": first["failed"],
+        "resume_skipped": second["skipped"],
+    }
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results, previous, threshold):
+    regressions = []
+
+    for name, result in results.items():
+        old = previous.get("results", {}).get(name)
+        if not old or not old.get("per_sec") or not result.get("per_sec"):
+            continue
+
+        ratio = result["per_sec"] / old["per_sec"]
+        print(f"{name}: {old['per_sec']} -> {result['per_sec']} ops/s ({ratio:.2f}x)")
+        if ratio < 1 - threshold:
+            regressions.append(name)
+
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline pipeline benchmarks.")
+    parser.add_argument("names", nargs="*", help="Benchmarks to run. Defaults to all of them.")
+    parser.add_argument("--posts", type=int, default=5000)
+    parser.add_argument("--blogs", type=int, default=10)
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per benchmark, the best one is kept.")
+    parser.add_argument("--postgres", action="store_true", help="Write to POSTGRES_URL instead of a fake session.")
+    parser.add_argument("--output", help="Write results as JSON to this path.")
+    parser.add_argument("--compare", help="Previous results to compare against.")
+    parser.add_argument("--threshold", type=float, default=0.10, help="Allowed slowdown before --compare fails.")
+    args = parser.parse_args()
+
+    results = {}
+    for name in args.names or BENCHMARKS:
+        runs = [BENCHMARKS[name](args) for _ in range(args.repeat)]
+        results[name] = max(runs, key=lambda result: result["per_sec"] or 0)
+        print(f"{name}: {json.dumps(results[name])}", file=sys.stderr, flush=True)
+
+    output = {
+        "meta": {
+            "time": time.time(),
+            "revision": git_revision(),
+            "python": platform.python_version(),
+            "implementation": platform.python_implementation(),
+            "posts": args.posts,
+            "blogs": args.blogs,
+        },
+        "results": results,
+    }
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(output, f, indent=2)
+    else:
+        print(json.dumps(output, indent=2))
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        if regressions:
+            print("Regressed: " + ", ".join(regressions), file=sys.stderr)
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -5,13 +5,18 @@ const client = require('prom-client');
 const redis = require('redis');
 
 // Constants
-const QUEUE_KEYS = [,
-  "tumblr:queue:posts",
-  "tumblr:queue:blogs",
-  "tumblr:queue:import",
-  "tumblr:queue:import:working",
-  "tumblr:queue:manualqueue"
-];
+// Same names as apipipeline/keys.py, the import queue keys carry a hash tag on a Redis Cluster.
+// The exporter itself still connects to a single node with redis.createClient().
+const tagged = (group, suffix = "") => process.env.REDIS_CLUSTER_NODES ? `{${group}}${suffix}` : group + suffix;
+
+// Gauge label -> Redis key.
+const QUEUE_KEYS = {
+  "tumblr:queue:posts": "tumblr:queue:posts",
+  "tumblr:queue:blogs": "tumblr:queue:blogs",
+  "tumblr:queue:import": tagged("tumblr:queue:import"),
+  "tumblr:queue:import:working": tagged("tumblr:queue:import", ":working"),
+  "tumblr:queue:manualqueue": "tumblr:queue:manualqueue"
+};
 
 // Server setup
 const register = client.register;
@@ -59,9 +64,8 @@ const updateGauges = async () => {
     workerPostsGauge.set({worker}, work);
   });
 
-  for (let i in QUEUE_KEYS) {
-    let queue = QUEUE_KEYS[i];
-    let queueSize = await redis_scard(queue);
+  for (let queue in QUEUE_KEYS) {
+    let queueSize = await redis_scard(QUEUE_KEYS[queue]);
     queueSizeGauge.set({queue}, queueSize);
   };
 };
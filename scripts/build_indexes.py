@@ -0,0 +1,105 @@
+"""
+Builds the indexes declared in apipipeline.model that the database is
+missing, with CREATE INDEX CONCURRENTLY so ingest keeps writing meanwhile.
+
+    python scripts/build_indexes.py                  # Every missing index.
+    python scripts/build_indexes.py post_tags_gin    # Only these.
+    python scripts/build_indexes.py --dry-run        # Print the statements.
+    python scripts/build_indexes.py --check          # EXPLAIN the apipipeline.queries helpers.
+
+A concurrent build that fails leaves an invalid index behind, it is dropped
+and built again on the next run.
+"""
+import re
+import sys
+import time
+import argparse
+
+from sqlalchemy import text
+from sqlalchemy.schema import CreateIndex
+
+from apipipeline.model import Base, get_engine, sm
+from apipipeline.queries import explain, posts_with_tags, posts_of_type, reblogs_of, posts_with_notes, blogs_needing_crawl
+
+EXISTING_QUERY = text(
+    "SELECT c.relname, i.indisvalid FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid "
+    "WHERE c.relname = ANY(:names)"
+)
+
+# Index name and a helper query that should use it.
+CHECKS = [
+    ("post_tags_gin", lambda db: posts_with_tags(db, "art")),
+    ("post_type", lambda db: posts_of_type(db, "answer")),
+    ("post_reblog_root", lambda db: reblogs_of(db, 1)),
+    ("post_note_count", lambda db: posts_with_notes(db, 100000)),
+    ("blog_needs_crawl", lambda db: blogs_needing_crawl(db)),
+]
+
+def declared_indexes():
+    return {index.name: index for table in Base.metadata.sorted_tables for index in table.indexes}
+
+def create_statement(index, dialect):
+    statement = str(CreateIndex(index).compile(dialect=dialect))
+    return re.sub(r"^CREATE (UNIQUE )?INDEX", r"CREATE \1INDEX CONCURRENTLY", statement)
+
+def build(names, dry_run=False, work_mem=None):
+    indexes = declared_indexes()
+    unknown = set(names) - set(indexes)
+    if unknown:
+        print("Unknown indexes: " + ", ".join(sorted(unknown)))
+        sys.exit(1)
+
+    # CONCURRENTLY can't run inside a transaction.
+    with get_engine().connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        existing = dict(conn.execute(EXISTING_QUERY, names=list(indexes)).fetchall())
+
+        if work_mem and not dry_run:
+            conn.execute(text("SET maintenance_work_mem = :work_mem"), work_mem=work_mem)
+
+        for name in names or indexes:
+            if existing.get(name):
+                print(f"{name}: exists.", flush=True)
+                continue
+
+            statements = [create_statement(indexes[name], conn.dialect)]
+            if name in existing:
+                statements.insert(0, f"DROP INDEX CONCURRENTLY {name}")
+
+            for statement in statements:
+                print(statement, flush=True)
+                if dry_run:
+                    continue
+
+                started = time.time()
+                conn.execute(text(statement))
+                print(f"{name}: done in {time.time() - started:.1f} seconds.", flush=True)
+
+def check():
+    db = sm()
+    missed = 0
+
+    try:
+        for name, make_query in CHECKS:
+            plan = explain(db, make_query(db))
+            used = any(name in line for line in plan)
+            missed += not used
+            print(f"{name}: {'used' if used else 'NOT used'} - {plan[0].strip()}", flush=True)
+    finally:
+        db.close()
+
+    if missed:
+        print("Indexes can be skipped on small or unanalyzed tables, run ANALYZE and check again.")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build declared indexes concurrently.")
+    parser.add_argument("names", nargs="*", help="Indexes to build. Defaults to every declared index.")
+    parser.add_argument("--dry-run", action="store_true", help="Only print the statements.")
+    parser.add_argument("--work-mem", help="maintenance_work_mem for the builds, like 2GB.")
+    parser.add_argument("--check", action="store_true", help="Check that the query helpers use their indexes.")
+    args = parser.parse_args()
+
+    if args.check:
+        check()
+    else:
+        build(args.names, args.dry_run, args.work_mem)
@@ -1,6 +1,7 @@
 import json
 import os
 import asyncio
+import argparse
 import functools
 import logging
 
@@ -13,59 +14,94 @@ from concurrent.futures import ProcessPoolExecutor
 
 from bs4 import BeautifulSoup
 
-from apipipeline import sentry_sdk
+from apipipeline import sentry_sdk, instrumentation, media
+from apipipeline.instrumentation import timed
 
 COMMON_WIDTHS = [2048, 1680, 1600, 1280, 1024, 1080, 768, 728, 500, 400, 250]
+
+# Stop loading rows while this many are waiting to be processed.
+MAX_PENDING_ITEMS = 100000
 logger = logging.getLogger(__name__)
 
-def extract_photos(data: dict, light: bool=False):
-    urls = defaultdict(lambda: set())
+# Buckets in the order a collapsed image is listed under.
+BUCKET_PRIORITY = ["photo_original", "link", "body", "content"]
 
+def collect_urls(data: dict, candidates: list):
     # Parse the trails too.
     for post in data.get("trail", []):
-        trail_urls = extract_photos(post)
-        urls.update(trail_urls)
+        collect_urls(post, candidates)
 
     # Photo posts
     if "photos" in data:
         for photo in data["photos"]:
-            urls["photo_original"].add(photo["original_size"]["url"])
+            candidates.append(("photo_original", photo["original_size"]["url"]))
             for alt_size in photo["alt_sizes"]:
                 # Common widths from Tumblr and other digital sources.
                 if alt_size["width"] in COMMON_WIDTHS:
                     photo_type_key = "photo_" + str(alt_size["width"])
                 else:
                     photo_type_key = "photo_otheralts"
-                urls[photo_type_key].add(alt_size["url"])
+                candidates.append((photo_type_key, alt_size["url"]))
 
     # Link posts
     if "link_image" in data and data["link_image"]:
-        urls["link"].add(data["link_image"])
+        candidates.append(("link", data["link_image"]))
 
     # General
-    if "body" in data and data["body"]:
-        parsed = BeautifulSoup(data["body"], 'html5lib')
-        for tag in parsed.findAll("img"):
-            urls["body"].add(tag["src"])
-
-    if "content" in data and data["content"]:
-        parsed = BeautifulSoup(data["content"], 'html5lib')
-        for tag in parsed.findAll("img"):
-            urls["content"].add(tag["src"])
-
-    if "content_raw" in data and data["content_raw"]:
-        parsed = BeautifulSoup(data["content_raw"], 'html5lib')
-        for tag in parsed.findAll("img"):
-            urls["content"].add(tag["src"])
-
-    return dict(urls)
-
+    for field, bucket in (("body", "body"), ("content", "content"), ("content_raw", "content")):
+        if field in data and data[field]:
+            parsed = BeautifulSoup(data[field], 'html5lib')
+            for tag in parsed.findAll("img"):
+                candidates.append((bucket, tag.get("src")))
+
+def extract_photos(data: dict, light: bool=False, collapse: bool=True, variants: bool=False):
+    candidates = []
+    collect_urls(data, candidates)
+
+    # Every size of every image, bucketed by width.
+    if not collapse:
+        urls = defaultdict(lambda: set())
+        for bucket, url in candidates:
+            if url:
+                urls[bucket].add(url)
+        return dict(urls)
+
+    # Only the largest size of each image. Alternate sizes belong to their photo.
+    candidates = [
+        ("photo_original" if bucket.startswith("photo_") else bucket, url)
+        for bucket, url in candidates
+    ]
+    return media.collapse(candidates, BUCKET_PRIORITY, variants)
+
+
+def write_photo_urls(directory):
+    # Original photo urls are a column in exports, no JSON parsing needed.
+    import pyarrow.compute
+    from apipipeline.export import read_batches
+
+    seen = set()
+    os.makedirs("urllists", exist_ok=True)
+    with open("urllists/photo_original", "w") as f:
+        f.write("url\n")
+        for batch in read_batches(directory, ["photo_urls"]):
+            urls = pyarrow.compute.unique(pyarrow.compute.list_flatten(batch.column(0)))
+            for url in urls.to_pylist():
+                # Reblogs carry the same image under other media hosts.
+                key = media.media_key(url)[0] if url else None
+                if key and key not in seen:
+                    seen.add(key)
+                    f.write("%s\n" % url)
+
+    return len(seen)
 
 class ImageListGenerator:
-    def __init__(self, loop):
+    def __init__(self, loop, parquet=None, collapse=True, variants=False):
         loop.set_exception_handler(self.on_asyncio_exception)
 
         self.loop = loop
+        self.parquet = parquet
+        self.collapse = collapse
+        self.variants = variants
         self.pool = ProcessPoolExecutor(max_workers=24)
 
         self.items = []
@@ -76,6 +112,8 @@ class ImageListGenerator:
         self.completed = defaultdict(lambda: 0)
 
         self.running = True
+        # Writers keep going until every processor has handed over its images.
+        self.extracting = True
 
     def on_asyncio_exception(self, loop, ctx):
         if sentry_sdk:
@@ -92,7 +130,7 @@ class ImageListGenerator:
         return self.files[filename]
 
     async def file_writer(self):
-        while self.running or len(self.images) > 0:
+        while self.extracting or len(self.images) > 0:
             # Sleep a short while, we will get images soon.
             if len(self.images) == 0:
                 await asyncio.sleep(0.1)
@@ -141,10 +179,13 @@ class ImageListGenerator:
 
             futures = [self.loop.run_in_executor(
                 self.pool,
-                functools.partial(extract_photos, item)
+                functools.partial(extract_photos, item, collapse=self.collapse, variants=self.variants)
             ) for item in items]
 
-            for index, photoset in enumerate(await asyncio.gather(*futures)):
+            with timed("extract"):
+                photosets = await asyncio.gather(*futures)
+
+            for index, photoset in enumerate(photosets):
                 data = items[index]
                 # Do something with the photos.
                 for image_type, images in photoset.items():
@@ -158,7 +199,7 @@ class ImageListGenerator:
 
     # Stats printing
     async def stats_printer(self):
-        while self.running or len(self.images) > 0:
+        while self.extracting or len(self.images) > 0:
             output = f"self.items: {len(self.items)}; self.images: {len(self.images)}; "
             if self.completed:
                 for item_type, item_count in self.completed.items():
@@ -167,14 +208,40 @@ class ImageListGenerator:
             print(output)
             await asyncio.sleep(1)
 
-    async def _run(self):
+    async def wait_for_room(self):
+        while len(self.items) > MAX_PENDING_ITEMS:
+            await asyncio.sleep(0.1)
+
+    async def load_postgres(self):
         # Connect to postgres.
         conn = await asyncpg.connect(dsn=os.environ["POSTGRES_URL"])
         logger.debug("PG connected.")
 
+        # Iterate all posts
+        async with conn.transaction():
+            async for post in conn.cursor("SELECT * FROM posts_warehouse"):
+                self.items.append(post)
+                if len(self.items) > MAX_PENDING_ITEMS:
+                    await self.wait_for_room()
+
+        await conn.close()
+
+    async def load_parquet(self):
+        # Reads the data column of an apipipeline.export directory instead of the database.
+        # Imported here, process pool workers never need pyarrow or the models.
+        from apipipeline.export import read_batches
+
+        for batch in read_batches(self.parquet, ["data"]):
+            self.items.extend({"data": data} for data in batch.column(0).to_pylist())
+            await self.wait_for_room()
+            # Batches load without I/O waits, give the processors a turn.
+            await asyncio.sleep(0)
+
+    async def _run(self):
         # Spin up tasks
+        processors = []
         for x in range(0, 8):
-            self.tasks.append(asyncio.ensure_future(self.process_content()))
+            processors.append(asyncio.ensure_future(self.process_content()))
             logger.debug("Processor %d started.", x)
 
         for x in range(0, 2):
@@ -188,17 +255,18 @@ class ImageListGenerator:
         # XXX Make this grab from Redis for real.
         last_crawled = 0
 
-        # Iterate all posts
-        async with conn.transaction():
-            async for post in conn.cursor("SELECT * FROM posts_warehouse"):
-                self.items.append(post)
+        if self.parquet:
+            await self.load_parquet()
+        else:
+            await self.load_postgres()
 
         # Cleanup
         self.running = False
-        await conn.close()
+        await asyncio.gather(*processors)
+        self.extracting = False
         await asyncio.gather(*self.tasks)
         for file_obj in self.files.values():
-            await file_obj.close()
+            file_obj.close()
 
     async def run(self):
         try:
@@ -207,7 +275,21 @@ class ImageListGenerator:
             self.running = False
 
 if __name__ == "__main__":
-    loop = asyncio.get_event_loop()
-    app = ImageListGenerator(loop)
-
-    loop.run_until_complete(app.run())
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Write image url lists to urllists/.")
+    parser.add_argument("--parquet", help="Read posts from an export directory, e.g. export/posts_warehouse.")
+    parser.add_argument("--photos-only", action="store_true", help="Only write original photo urls. Needs --parquet.")
+    parser.add_argument("--all-variants", action="store_true", help="Write every size of every image, bucketed by width.")
+    parser.add_argument("--variant-index", action="store_true", help="Also write the sizes seen per image to urllists/variants.")
+    args = parser.parse_args()
+
+    if args.photos_only and not args.parquet:
+        parser.error("--photos-only reads the photo_urls column of an export, give --parquet.")
+
+    if args.photos_only:
+        print(f"{write_photo_urls(args.parquet)} photo urls written.")
+    else:
+        loop = asyncio.get_event_loop()
+        app = ImageListGenerator(loop, args.parquet, collapse=not args.all_variants, variants=args.variant_index)
+        instrumentation.start("create_urlist")
+
+        loop.run_until_complete(app.run())
\ No newline at end of file
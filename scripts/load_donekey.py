@@ -1,13 +1,21 @@
 from apipipeline.connections import create_redis
+from apipipeline.keys import DONE, lookup_set
 from apipipeline.model import Blog, sm
 
 db = sm()
 redis = create_redis()
+done = lookup_set(redis, DONE)
 
 i = 0
+names = []
 
 for blog in db.query(Blog).yield_per(1024):
-    redis.sadd("tumblr:done", blog.name.strip() + ".tumblr.com")
+    names.append(blog.name.strip() + ".tumblr.com")
     i += 1
     if i % 500 == 0:
+        done.add(*names)
+        names.clear()
         print(i, flush=True)
+
+done.add(*names)
+print(i, flush=True)
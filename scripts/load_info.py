@@ -1,132 +1,200 @@
-import random
-import time
-import json
-import threading
+"""
+Fetches blog info for every url in tumblr:urls that is not in tumblr:done and
+queues it for the parser.
+
+    python scripts/load_info.py          # Stream tumblr:urls, resumes where it stopped.
+    python scripts/load_info.py --db     # Recheck blogs that need a crawl and queue them for the loader.
+"""
 import os
+import sys
+import random
+import asyncio
+import argparse
 import traceback
 
-from sqlalchemy import or_, Integer, func
-from redis import StrictRedis
-from apipipeline import sentry_sdk
-from apipipeline.connections import redis_pool, create_tumblr
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import Integer, func
+from apipipeline import sentry_sdk, instrumentation
+from apipipeline.capture import capture
+from apipipeline.connections import create_redis, create_tumblr
+from apipipeline.instrumentation import timed
+from apipipeline.keys import URLS, DONE, NOT_FOUND, BAD_INFO, BLOGS_QUEUE, MANUAL_QUEUE, LOAD_INFO_CURSOR, ShardedSet, lookup_set
 from apipipeline.model import Blog, sm
+from apipipeline.negcache import NegativeCache
+from apipipeline.queries import blogs_needing_crawl
+from apipipeline.ratelimit import RateLimiter
+from apipipeline.utils import encode_payload
 
 # Connectors
-redis = StrictRedis(connection_pool=redis_pool)
+redis = create_redis()
 tumblr = create_tumblr()
 
-# Redis lua
-GET_REMAINING_SCRIPT = """
-local url_total = redis.call('SCARD', 'tumblr:urls')
-local done_total = redis.call('SCARD', 'tumblr:done')
-return url_total - done_total"""
-get_remaining = redis.register_script(GET_REMAINING_SCRIPT)
-
-# Actual grabber
-backoff = 2
-running = True
-do_worker_queue = False
+urls_set = ShardedSet(redis, URLS)
+done_set = lookup_set(redis, DONE)
+negative = NegativeCache(redis)
 
-urls = []
-workers = []
+CONCURRENCY = int(os.environ.get("WORKERS", 4))
+BATCH_SIZE = int(os.environ.get("BATCH_SIZE", 500))
 
-def process_url(sql, url):
-    global backoff
+limiter = RateLimiter(float(os.environ.get("REQUESTS_PER_SECOND", 5)) * len(tumblr))
+executor = ThreadPoolExecutor(max_workers=CONCURRENCY)
 
-    # Skip over blogs we've already passed through.
-    # Adding directly from SQL means we are reprocessing.
-    if not do_worker_queue and redis.sismember("tumblr:done", url):
-        return
+class Discovery(object):
+    def __init__(self, queue_manual=False):
+        self.queue_manual = queue_manual
+        self.semaphore = asyncio.Semaphore(CONCURRENCY)
+        self.backoff = 2
+        self.retries = []
+        self.remaining = 0
 
-    # Query
-    info = tumblr.blog_info(url)
-
-    # Ignore 404s
-    if "meta" in info:
-        if info["meta"]["status"] == 404:
-            print(f"{url} - 404")
-            redis.sadd("tumblr:done", url)
-            redis.sadd("tumblr:404", url)
-            return False
-        elif info["meta"]["status"] == 429:
-            urls.append(url)
-            print(f"Got 429. Backing off for {backoff} secs.")
-            time.sleep(backoff)
-            backoff = min(120, backoff ** random.uniform(1, 2))
-            return
-
-    # wot how
-    if "blog" not in info:
-        print(info)
-        print()
-        redis.sadd("tumblr:done", url)
-        redis.sadd("tumblr:badinfo", url)
-        return
-
-    # Reset backoff if we make it this far.
-    if backoff != 2:
-        backoff = 2
-
-    # Make a new blog and log.
-    redis.sadd("tumblr:queue:blogs", json.dumps(info))
-    print(f"{url} - {info['blog']['posts']} posts; {get_remaining() - 1} remaining.")
-
-    return info
-
-def worker():
-    sql = sm()
-
-    while running and len(urls) > 0:
-        url = urls.pop(random.randrange(len(urls)))
+    async def fetch_info(self, url):
+        async with self.semaphore:
+            await limiter.wait_async()
+            with timed("api_wait"):
+                return await asyncio.get_event_loop().run_in_executor(executor, tumblr.blog_info, url)
 
+    async def process_url(self, url):
         try:
-            info = process_url(sql, url)
-            if info and do_worker_queue:
-                print("added")
-                redis.sadd("tumblr:queue:manualqueue", info["blog"]["name"])
-        except:
+            info = await self.fetch_info(url)
+        except Exception:
             if sentry_sdk:
                 sentry_sdk.capture_exception()
             traceback.print_exc()
+            return url, "retry", None
 
-if __name__ == "__main__":
-    main_sql = sm()
+        status = info.get("meta", {}).get("status")
+
+        # Ignore 404s
+        if status == 404:
+            print(f"{url} - 404")
+            return url, "404", None
+        elif status == 429:
+            print(f"Got 429. Backing off for {self.backoff} secs.")
+            limiter.pause(self.backoff)
+            self.backoff = min(120, self.backoff ** random.uniform(1, 2))
+            return url, "retry", None
+        elif status not in (None, 200):
+            # Outages and revoked keys are not the blog's fault.
+            print(f"{url} - {status}")
+            return url, "retry", None
+
+        # wot how
+        if "blog" not in info:
+            print(info)
+            return url, "bad", None
+
+        # Reset backoff if we make it this far.
+        self.backoff = 2
+
+        print(f"{url} - {info['blog']['posts']} posts")
+        return url, "ok", info
+
+    async def process_batch(self, urls):
+        results = await asyncio.gather(*[self.process_url(url) for url in urls])
+
+        # Write everything for the batch in one round trip.
+        with timed("enqueue"):
+            pipe = redis.pipeline(transaction=False)
+            blogs = []
+
+            for url, status, info in results:
+                if status == "retry":
+                    self.retries.append(url)
+                    continue
+
+                done_set.add(url, pipe=pipe)
+                if status == "404":
+                    pipe.sadd(NOT_FOUND, url)
+                    negative.mark(url, "404", pipe=pipe)
+                elif status == "bad":
+                    pipe.sadd(BAD_INFO, url)
+                    negative.mark(url, "bad", pipe=pipe)
+                elif status == "ok":
+                    blogs.append(encode_payload(info))
+                    pipe.sadd(BLOGS_QUEUE, blogs[-1])
+                    negative.clear(url, pipe=pipe)
+                    if self.queue_manual:
+                        pipe.sadd(MANUAL_QUEUE, info["blog"]["name"])
+
+            pipe.execute()
+
+        capture.record(BLOGS_QUEUE, capture.sample(blogs))
+
+        done = sum(1 for _, status, _ in results if status != "retry")
+        self.remaining = max(0, self.remaining - done)
+        print(f"Batch of {len(urls)} done. {self.remaining} remaining, {len(self.retries)} to retry.", flush=True)
+
+    async def run_urls(self, urls):
+        for index in range(0, len(urls), BATCH_SIZE):
+            await self.process_batch(urls[index:index + BATCH_SIZE])
+
+        await self.drain_retries()
+
+    async def drain_retries(self):
+        while self.retries:
+            urls, self.retries = self.retries[:BATCH_SIZE], self.retries[BATCH_SIZE:]
+            await self.process_batch(urls)
+
+    def pending(self, urls):
+        # Drop urls that are already done or known dead with one round trip each per batch.
+        urls = [url for url, done in zip(urls, done_set.contains(urls)) if not done]
+        return [url for url, dead in zip(urls, negative.dead(urls)) if not dead]
+
+    async def run_scan(self):
+        cursor = redis.get(LOAD_INFO_CURSOR) or "0"
+        self.remaining = urls_set.count() - done_set.count()
+        print(f"Starting at cursor {cursor}, about {self.remaining} urls remaining.", flush=True)
+
+        while True:
+            cursor, urls = urls_set.scan(cursor, count=BATCH_SIZE)
+            urls = self.pending(urls)
 
-    # urls must be set to a list with strings blah.tumblr.com
-    # urls = list(redis.sdiff("tumblr:urls", "tumblr:done"))
+            if urls:
+                await self.process_batch(urls)
 
-    do_worker_queue = True
+            # Retries ride along with later batches instead of blocking the scan.
+            if len(self.retries) >= BATCH_SIZE:
+                await self.drain_retries()
 
-    # load file
-    # with open("blogs", "r") as f:
-    #     content = f.read().split("\n")
-    #     for url in content:
-    #         # url = url.split("tumblr-blog:", 1)[1]
-    #         urls.append(url.strip() + ".tumblr.com")
+            if cursor == "0":
+                break
 
-    # load db
-    i = 0
-    blogs = main_sql.query(Blog).filter(or_(
-        Blog.updated != Blog.last_crawl_update,
-        Blog.last_crawl_update == None
-    )).filter(Blog.data['posts'].cast(Integer) < 10000).order_by(func.random()).limit(2048).all()
+            # Pending retries are not in tumblr:done, the next full pass picks them up after a crash.
+            redis.set(LOAD_INFO_CURSOR, cursor)
+
+        await self.drain_retries()
+        redis.delete(LOAD_INFO_CURSOR)
+
+def load_db_urls(limit):
+    sql = sm()
+    blogs = blogs_needing_crawl(sql).filter(Blog.data['posts'].cast(Integer) < 10000).order_by(func.random()).limit(limit).all()
 
-    for blog in blogs:
-        print(i, blog.name, blog.data['posts'])
-        urls.append(blog.name.strip() + ".tumblr.com")
-        i += 1
+    urls = [blog.name.strip() + ".tumblr.com" for blog in blogs]
+    urls = [url for url, dead in zip(urls, negative.dead(urls)) if not dead]
+    sql.close()
 
-    for x in range(0, int(os.environ.get("WORKERS", 4))):
-        t = threading.Thread(target=worker)
-        t.start()
-        workers.append(t)
+    return urls
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load blog info into the parser queue.")
+    parser.add_argument("--db", action="store_true", help="Recheck blogs from the database and queue them for the loader.")
+    parser.add_argument("--limit", type=int, default=2048, help="Blogs to recheck with --db.")
+    args = parser.parse_args()
+
+    instrumentation.start("load_info", redis)
+    loop = asyncio.get_event_loop()
 
     try:
-        while True:
-            time.sleep(1)
+        if args.db:
+            discovery = Discovery(queue_manual=True)
+            urls = load_db_urls(args.limit)
+            discovery.remaining = len(urls)
+            loop.run_until_complete(discovery.run_urls(urls))
+        else:
+            loop.run_until_complete(Discovery().run_scan())
     except KeyboardInterrupt:
-        running = False
         print("Stopping!")
-
-    for t in workers:
-        t.join()
+        sys.exit(1)
+    finally:
+        executor.shutdown(wait=False)
@@ -1,8 +1,10 @@
 from apipipeline.connections import create_redis
-from apipipeline.model import Post, engine
+from apipipeline.keys import WAREHOUSED, lookup_set
+from apipipeline.model import Post, get_engine
 
 redis = create_redis()
-redis_pipe = redis.pipeline()
+engine = get_engine()
+warehoused = lookup_set(redis, WAREHOUSED)
 
 author_uids = {}
 i = 0
@@ -31,8 +33,10 @@ with engine.connect() as db_conn:
     
             i += 1
             if i % 1500 == 0:
-                redis.sadd("tumblr:warehoused", *warehouse_keys)
+                warehoused.add(*warehouse_keys)
                 print(f"{i} done. {total_posts - i} remaining. {len(author_uids)} in cache.", flush=True)
                 warehouse_keys.clear()
 
+    warehoused.add(*warehouse_keys)
+
 print(i, flush=True)
@@ -0,0 +1,103 @@
+"""
+Moves existing Redis keys to the compact encodings.
+
+    python scripts/migrate_compact.py --jobs            # Re-encode queued JSON import jobs.
+    python scripts/migrate_compact.py --sets            # Copy tumblr:done and tumblr:warehoused into HashedSets.
+    python scripts/migrate_compact.py --sets --delete   # Also drop the old sets once copied.
+
+Start the workers with REDIS_COMPACT_SETS=1 after --sets. HashedSets can't be
+turned back into plain sets, keep the old keys until that is done.
+
+Each hashed set gets a power of two buckets, about HASHED_BUCKET_MEMBERS
+members each for the current size of the set, unless --buckets is given.
+Leave room for growth, a bucket over hash-max-listpack-entries is stored as
+a full hash table again.
+"""
+import math
+import argparse
+
+from apipipeline.connections import create_redis
+from apipipeline.jobs import encode_job, decode_job
+from apipipeline.keys import IMPORT_QUEUE, DONE, WAREHOUSED, HASHED_BUCKET_MEMBERS, ShardedSet, HashedSet
+
+BATCH_SIZE = 1000
+
+redis = create_redis()
+
+def migrate_jobs():
+    cursor = 0
+    migrated = 0
+
+    while True:
+        cursor, members = redis.sscan(IMPORT_QUEUE, cursor, count=BATCH_SIZE)
+
+        pipe = redis.pipeline(transaction=False)
+        for member in members:
+            if not member.startswith("{"):
+                continue
+
+            try:
+                compact = encode_job(decode_job(member), encoding="compact")
+            except (TypeError, ValueError, KeyError):
+                print(f"Skipping bad job {member!r}.", flush=True)
+                continue
+
+            # Adding first, a crash in between leaves a duplicate rather than losing the job.
+            pipe.sadd(IMPORT_QUEUE, compact)
+            pipe.srem(IMPORT_QUEUE, member)
+            migrated += 1
+        pipe.execute()
+
+        if int(cursor) == 0:
+            break
+
+    # SSCAN may return a member twice, re-adding it is harmless.
+    print(f"{migrated} import jobs re-encoded.", flush=True)
+
+def bucket_count(members):
+    return max(1024, 2 ** math.ceil(math.log2(max(members, 1) / HASHED_BUCKET_MEMBERS)))
+
+def migrate_set(name, delete=False, buckets=None):
+    source = ShardedSet(redis, name)
+    members = source.count()
+
+    # A set that was already (partly) migrated keeps its stored count.
+    target = HashedSet(redis, name, buckets=buckets or bucket_count(members))
+    if redis.get(target.meta_key) is not None and not buckets:
+        target = HashedSet(redis, name)
+
+    print(f"{name}: {members} members into {target.buckets} buckets.", flush=True)
+    cursor = "0"
+    copied = 0
+
+    while True:
+        cursor, members = source.scan(cursor, count=BATCH_SIZE)
+        target.add(*members)
+        copied += len(members)
+
+        if copied and copied % (BATCH_SIZE * 100) < len(members):
+            print(f"{name}: {copied} copied.", flush=True)
+
+        if cursor == "0":
+            break
+
+    print(f"{name}: {copied} members copied, {target.count()} in the hashed set.", flush=True)
+
+    if delete:
+        redis.delete(*source.keys, source.meta_key)
+        print(f"{name}: old keys deleted.", flush=True)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Migrate Redis keys to the compact encodings.")
+    parser.add_argument("--jobs", action="store_true", help="Re-encode JSON jobs in the import queue.")
+    parser.add_argument("--sets", action="store_true", help="Copy the lookup sets into hashed sets.")
+    parser.add_argument("--delete", action="store_true", help="Delete the old lookup sets after copying.")
+    parser.add_argument("--buckets", type=int, help="Buckets per hashed set. Defaults to about 100 members each.")
+    args = parser.parse_args()
+
+    if args.jobs:
+        migrate_jobs()
+
+    if args.sets:
+        for name in (DONE, WAREHOUSED):
+            migrate_set(name, args.delete, args.buckets)